@@ -4,7 +4,7 @@ import sys
 import pytest
 
 from src.ghgen.ctx import workflow, GenerationError
-from src.ghgen import generate_workflow
+from src.ghgen import generate_workflow, render_workflow, emit
 import pathlib
 import inspect
 import dis
@@ -14,6 +14,11 @@ import subprocess
 
 def pytest_addoption(parser):
     parser.addoption("--learn", action="store_true")
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        help="also run benchmarks, whose timings depend on the load of the machine",
+    )
 
 
 @dataclasses.dataclass(frozen=True)
@@ -43,6 +48,21 @@ _learn = pytest.StashKey[list[tuple[_Call, str | None]]]()
 
 def pytest_configure(config: pytest.Config):
     config.stash[_learn] = []
+    config.addinivalue_line(
+        "markers", "benchmark: skipped unless `--benchmark` is given"
+    )
+
+
+def pytest_collection_modifyitems(config: pytest.Config, items: list[pytest.Item]):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="benchmark, run with `--benchmark`")
+    for item in items:
+        if item.get_closest_marker("benchmark"):
+            item.add_marker(skip)
+
+
+_backends = ["ruamel"] + (["libyaml"] if emit.libyaml_available() else [])
 
 
 def expect(expected: str | None = None):
@@ -55,7 +75,11 @@ def expect(expected: str | None = None):
             wf = workflow(f)
             output = generate_workflow(wf, pathlib.Path(inspect.getfile(f)).parent)
             with open(output) as out:
-                actual = [l.rstrip("\n") for l in out]
+                text = out.read()
+            actual = text.splitlines()
+            # every emitter backend must give the same output
+            for backend in _backends:
+                assert render_workflow(wf, backend) == text, f"{backend} output differs"
             if expected is None or pytestconfig.getoption("--learn"):
                 pytestconfig.stash[_learn].append((call, "\n".join(actual)))
             else:
@@ -1,19 +1,58 @@
-import argparse
+from __future__ import annotations
+
+# This module is imported by the `gh-gen` entry point, so it must import quickly: heavy modules
+# (including the workflow model in `.ctx`) are only loaded on the code paths that need them.
+
+import contextlib
+import dataclasses
+import functools
+import gc
+import importlib
 import importlib.util
+import io
+import itertools
 import logging
+import os
+import pathlib
+import re
 import sys
+import time
 import typing
-import pathlib
-import difflib
 
-from ruamel.yaml import YAML, CommentedMap
+from .cache import (
+    Cache,
+    Entry,
+    SharedCache,
+    file_digest,
+    parse_age,
+    parse_size,
+    shared_dir_env_var,
+    default_dir_name as default_cache_dir_name,
+)
+from .deps import track_imports, untracked, invalidate, record as record_dependencies
+from .client import socket_env_var, default_socket_name
+from . import fingerprint, shard, timings, profiling, memory, metrics, emit
 
-from .ctx import WorkflowInfo, GenerationError
-import functools
-import colorlog
+if typing.TYPE_CHECKING:
+    import argparse
+
+    from .ctx import WorkflowInfo
+    from .scan import Scanner
+
+# names made available lazily through `__getattr__`, mapped to the module providing them
+_lazy_imports = {
+    "WorkflowInfo": ".ctx",
+    "GenerationError": ".ctx",
+    "_ctx": ".ctx",
+}
 
-yaml = YAML()
-yaml.default_flow_style = False
+
+def __getattr__(name: str) -> typing.Any:
+    if name == "yaml":
+        return emit.ruamel_yaml()
+    if name in _lazy_imports:
+        return getattr(importlib.import_module(_lazy_imports[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class DiffError(Exception):
@@ -22,31 +61,105 @@ class DiffError(Exception):
         self.errors = diff
 
 
-def generate_workflow(
-    w: WorkflowInfo, dir: pathlib.Path, check=False
-) -> pathlib.Path | None:
-    input = f"{w.file.name}::{w.spec.__name__}"
-    output = (dir / w.id).with_suffix(".yml")
-    tmp = output.with_suffix(".yml.tmp")
-    w = w.worfklow.asdict()
-    w = CommentedMap(w)
-    w.yaml_set_start_comment(f"generated from {input}")
-    with open(tmp, "w") as out:
-        yaml.dump(w, out)
+def _subject(w: WorkflowInfo) -> str:
+    return f"{w.file.name}::{w.id}"
+
+
+def render_workflow(
+    w: WorkflowInfo,
+    emitter: str = "auto",
+    format: str = "yaml",
+    anchors: int | None = None,
+) -> str:
+    header = f"generated from {w.file.name}::{w.spec.__name__}"
+    with timings.subject(_subject(w)):
+        w = w.worfklow
+        out = io.StringIO()
+        if format == "json":
+            with timings.phase("asdict"):
+                w = w.asdict()
+            # JSON has no comments, but outputs are read as YAML: the header is kept as YAML
+            # comments, so that fingerprints and dependencies work the same for both formats
+            out.write(f"# {header}\n")
+            with timings.phase("dump"):
+                emit.dump_json(w, out)
+            return out.getvalue()
+        if anchors is not None:
+            with timings.phase("asdict"):
+                w, _ = emit.share_subtrees(w.asdict(), anchors)
+        with timings.phase("dump"):
+            # serialization is streamed as part of this phase where possible
+            emit.dump(w, out, emitter, header, aliases=anchors is not None)
+    return out.getvalue()
+
+
+def _is_up_to_date(data: bytes, output: pathlib.Path) -> bool:
+    try:
+        # cheap size check first, only reading the file if needed
+        if output.stat().st_size != len(data):
+            return False
+        with open(output, "rb") as current:
+            return current.read() == data
+    except FileNotFoundError:
+        return False
+
+
+def _stage(text: str, output: pathlib.Path) -> pathlib.Path:
+    tmp = output.with_name(f".{output.name}.{os.getpid()}.tmp")
+    data = text.encode()
+    with open(tmp, "wb") as out:
+        out.write(data)
+    metrics.count("io.bytes_written", len(data))
+    return tmp
+
+
+def _commit(writes: dict[pathlib.Path, str]):
+    """Write all `writes` at once, or none of them in case of errors while writing"""
+    if writes:
+        with timings.span("write", outputs=len(writes)):
+            _write_all(writes)
+
+
+def _write_all(writes: dict[pathlib.Path, str]):
+    metrics.count("io.files_written", len(writes))
+    staged = []
+    try:
+        for output, text in writes.items():
+            staged.append((_stage(text, output), output))
+    except BaseException:
+        for tmp, _ in staged:
+            tmp.unlink(missing_ok=True)
+        raise
+    for tmp, output in staged:
+        tmp.replace(output)
+
+
+def write_workflow(text: str, output: pathlib.Path, check=False):
+    if _is_up_to_date(text.encode(), output):
+        return
     if check:
-        if output.exists():
-            with open(output) as current:
-                current = [*current]
-        else:
+        import difflib
+
+        try:
+            with open(output, encoding="utf-8", newline="") as current:
+                current = current.read().splitlines(keepends=True)
+        except FileNotFoundError:
             current = []
-        with open(tmp) as new:
-            new = [*new]
-        diff = list(difflib.unified_diff(current, new, str(output), str(tmp)))
-        if diff:
-            raise DiffError([l.rstrip("\n") for l in diff])
-        tmp.unlink()
-    else:
-        tmp.rename(output)
+        new = text.splitlines(keepends=True)
+        diff = difflib.unified_diff(current, new, str(output), f"{output} (generated)")
+        raise DiffError([l.rstrip("\n") for l in diff])
+    _commit({output: text})
+
+
+def workflow_output(dir: pathlib.Path, id: str) -> pathlib.Path:
+    return (dir / id).with_suffix(".yml")
+
+
+def generate_workflow(
+    w: WorkflowInfo, dir: pathlib.Path, check=False, emitter: str = "auto"
+) -> pathlib.Path | None:
+    output = workflow_output(dir, w.id)
+    write_workflow(render_workflow(w, emitter), output, check)
     return output
 
 
@@ -76,40 +189,791 @@ def relativized_path(p: str | pathlib.Path) -> pathlib.Path:
         return p
 
 
-def generate(opts: argparse.Namespace):
-    sys.path.extend(map(str, opts.includes))
-    sys.modules["ghgen"] = sys.modules[__name__]
-    inputs = opts.inputs or opts.includes
+@dataclasses.dataclass
+class _SpecResult:
+    found: bool = False
+    failed: bool = False
+    records: list[tuple[int, str]] = dataclasses.field(default_factory=list)
+    output: str | None = None
+    writes: dict[pathlib.Path, str] = dataclasses.field(default_factory=dict)
+    elapsed: float = 0.0
+    times: timings.Times = dataclasses.field(default_factory=dict)
+    events: list[dict[str, typing.Any]] = dataclasses.field(default_factory=list)
+    profiles: list[pathlib.Path] = dataclasses.field(default_factory=list)
+    peaks: timings.Peaks = dataclasses.field(default_factory=dict)
+    sites: memory.Sites = dataclasses.field(default_factory=dict)
+    metrics: metrics.Registry | None = None
+
+    def log(self, level: int, message: str):
+        self.records.append((level, message))
+
+
+def _setup(opts: argparse.Namespace):
+    _generated_outputs.cache_clear()
+    sys.path.extend(str(i) for i in opts.includes if str(i) not in sys.path)
+    # make `ghgen` (and submodules) available to input files even if imported under a different name
+    if __name__ != "ghgen":
+        importlib.import_module(".ctx", __name__)
+    for name, mod in list(sys.modules.items()):
+        if name == __name__ or name.startswith(f"{__name__}."):
+            sys.modules[f"ghgen{name.removeprefix(__name__)}"] = mod
+
+
+def _emit(
+    ret: _SpecResult, id: str, text: str, opts: argparse.Namespace
+) -> pathlib.Path:
+    output = workflow_output(opts.output_directory, id)
+    write_workflow(text, output, check=opts.check)
+    ret.log(logging.INFO, f"{'✅' if opts.check else '→'} {output}")
+    return output
+
+
+def _output_options(opts: argparse.Namespace) -> str:
+    """Get the options changing generated text, for caches and fingerprints"""
+    ret = opts.format
+    if opts.anchors is not None:
+        ret += f" anchors={opts.anchors}"
+    return ret
+
+
+def _caches(opts: argparse.Namespace) -> tuple[Cache | None, SharedCache | None]:
+    output_options = _output_options(opts)
+    cache = opts.cache_directory and Cache(opts.cache_directory, output_options)
+    shared = opts.shared_cache_directory and SharedCache(
+        opts.shared_cache_directory, output_options
+    )
+    return cache or None, shared or None
+
+
+def _cached_entry(
+    f: pathlib.Path, opts: argparse.Namespace, ret: _SpecResult
+) -> Entry | None:
+    """Get the workflows generated by `f` from the caches, if there"""
+    if opts.strict:
+        return None
+    cache, shared = _caches(opts)
+    key = cache and cache.key(f)
+    entry = cache and cache.get(f, key)
+    if cache:
+        metrics.count("cache.hits" if entry else "cache.misses")
+    if not entry and shared:
+        entry = shared.get(f)
+        metrics.count("shared_cache.hits" if entry else "shared_cache.misses")
+        if entry:
+            ret.log(logging.DEBUG, f"shared cache hit for {f}")
+            if cache:
+                entry.key = key
+                cache.put(f, entry)
+    if not entry:
+        return None
+    ret.log(logging.DEBUG, f"cache hit for {f}")
+    ret.found = bool(entry.workflows)
+    # so that changes to dependencies are tracked without having executed `f`
+    record_dependencies(f, map(pathlib.Path, entry.dependencies))
+    return entry
+
+
+def _load_spec(
+    f: pathlib.Path,
+    opts: argparse.Namespace,
+    ret: _SpecResult,
+    profiles: profiling.Profiles = profiling.Profiles(enabled=False),
+) -> Entry:
+    """Get the workflows generated by `f` by executing it, caching them"""
+    from .ctx import WorkflowInfo, GenerationError
+
+    cache, shared = _caches(opts)
+    entry = Entry(cache and cache.key(f))
+    sampler = opts.memory_report and memory.Sampler(opts.includes + opts.inputs)
+    with track_imports(f, opts.includes + opts.inputs) as dependencies:
+        spec = importlib.util.spec_from_file_location(f.name, str(f))
+        mod = importlib.util.module_from_spec(spec)
+        with timings.phase("exec", str(f), file=str(f)):
+            spec.loader.exec_module(mod)
+        for k, v in mod.__dict__.items():
+            if isinstance(v, WorkflowInfo):
+                ret.found = True
+                try:
+                    with profiles.workflow(v.id):
+                        # building runs spec code, which may import files, rendering does not
+                        with timings.subject(_subject(v)):
+                            _ = v.worfklow
+                        with untracked():
+                            entry.workflows[v.id] = render_workflow(
+                                v, opts.emitter, opts.format, opts.anchors
+                            )
+                            if opts.anchors is not None:
+                                _report_anchors(v, entry.workflows[v.id], opts, ret)
+                except GenerationError as e:
+                    ret.failed = True
+                    for error in e.errors:
+                        ret.log(logging.ERROR, str(error))
+                if opts.stream:
+                    v.release()
+        if sampler:
+            # sample while the spec module and its workflows are still alive
+            ret.sites = sampler.sample()
+        if opts.stream:
+            # functions in the module reference its namespace, clearing it breaks that cycle so that
+            # everything is freed right away rather than whenever the garbage collector runs
+            mod.__dict__.clear()
+    entry.dependencies = {str(d): file_digest(d) for d in sorted(dependencies)}
+    relative_dependencies = fingerprint.relative_dependencies(f, dependencies)
+    for id, text in entry.workflows.items():
+        fp = fingerprint.compute(
+            f, relative_dependencies, entry.workflows, text, _output_options(opts)
+        )
+        entry.workflows[id] = fingerprint.stamp(text, fp, relative_dependencies)
+    if cache and not ret.failed:
+        cache.put(f, entry)
+    if shared and not ret.failed:
+        shared.put(f, entry)
+    return entry
+
+
+def _report_anchors(
+    w: WorkflowInfo, text: str, opts: argparse.Namespace, ret: _SpecResult
+):
+    saved = len(render_workflow(w, opts.emitter).encode()) - len(text.encode())
+    metrics.count_by("anchors.bytes_saved", w.id, saved)
+    ret.log(logging.INFO, f"anchors save {saved} bytes in {w.id}")
+
+
+@functools.cache
+def _generated_outputs(dir: pathlib.Path) -> dict[str, list[pathlib.Path]]:
+    """Index outputs in `dir` by the name of the input file they were generated from"""
+    ret = {}
+    for output in sorted(dir.glob("*.yml")):
+        with open(output, encoding="utf-8") as out:
+            m = re.fullmatch(r"# generated from (.*)::.*\n", out.readline())
+        if m:
+            ret.setdefault(m[1], []).append(output)
+    return ret
+
+
+def _check_fingerprints(
+    f: pathlib.Path, opts: argparse.Namespace, ret: _SpecResult
+) -> bool:
+    """Check outputs of `f` are up to date without executing it, using their fingerprints"""
+    outputs = _generated_outputs(opts.output_directory).get(f.name)
+    if not outputs:
+        metrics.count("fingerprint.misses")
+        return False
+    ids = [o.stem for o in outputs]
+    output_options = _output_options(opts)
+    known = set()
+    try:
+        for output in outputs:
+            fp, dependencies, text = fingerprint.parse(
+                output.read_text(encoding="utf-8")
+            )
+            if fp != fingerprint.compute(f, dependencies, ids, text, output_options):
+                metrics.count("fingerprint.misses")
+                return False
+            known.update((f.parent / d) for d in dependencies)
+    except OSError:
+        metrics.count("fingerprint.misses")
+        return False
+    metrics.count("fingerprint.hits")
+    record_dependencies(f, known)
+    ret.log(logging.DEBUG, f"fingerprints match for {f}")
+    ret.found = True
+    for output in outputs:
+        ret.log(logging.INFO, f"✅ {output}")
+    return True
+
+
+def _reuse_outputs(f: pathlib.Path, opts: argparse.Namespace) -> _SpecResult | None:
+    """Process `f` without executing it, if its outputs are known to be up to date or its
+    workflows are cached, or return `None`"""
+    # log records are collected rather than emitted, so that they can be replayed in input order
+    # regardless of which process did the work
+    ret = _SpecResult()
+    ret.log(logging.DEBUG, f"← {f}")
+    if opts.check and not opts.strict and _check_fingerprints(f, opts, ret):
+        return ret
+    entry = _cached_entry(f, opts, ret)
+    if entry is None:
+        return None
+    _compare_all(ret, f, entry, opts)
+    return ret
+
+
+def _generate_spec(f: pathlib.Path, opts: argparse.Namespace) -> _SpecResult:
+    """Process `f` executing it"""
+    ret = _SpecResult()
+    ret.log(logging.DEBUG, f"← {f}")
+    profiles = profiling.Profiles(enabled=bool(opts.profile))
+    entry = _load_spec(f, opts, ret, profiles)
+    _compare_all(ret, f, entry, opts, profiles)
+    if opts.profile:
+        ret.profiles = profiles.dump(opts.profile)
+    return ret
+
+
+def _compare_all(
+    ret: _SpecResult,
+    f: pathlib.Path,
+    entry: Entry,
+    opts: argparse.Namespace,
+    profiles: profiling.Profiles = profiling.Profiles(enabled=False),
+):
+    for id, text in entry.workflows.items():
+        output = workflow_output(opts.output_directory, id)
+        metrics.observe("output.bytes", len(text.encode()))
+        with (
+            profiles.workflow(id),
+            timings.phase("diff", f"{f.name}::{id}", output=str(output)),
+        ):
+            _compare(ret, text, output, opts)
+
+
+def _compare(
+    ret: _SpecResult, text: str, output: pathlib.Path, opts: argparse.Namespace
+):
+    if not opts.check:
+        if _is_up_to_date(text.encode(), output):
+            ret.log(logging.INFO, f"= {output}")
+        else:
+            # actual writing is done once all workflows were successfully generated
+            ret.writes[output] = text
+            ret.log(logging.INFO, f"→ {output}")
+        return
+    try:
+        write_workflow(text, output, check=True)
+        ret.log(logging.INFO, f"✅ {output}")
+    except DiffError as e:
+        ret.failed = True
+        for error in e.errors:
+            ret.log(logging.ERROR, str(error))
+
+
+def _reuse_dependencies(
+    f: pathlib.Path, opts: argparse.Namespace
+) -> _SpecResult | None:
+    ret = _SpecResult()
+    entry = _cached_entry(f, opts, ret)
+    if entry is None:
+        return None
+    _output_dependencies(ret, f, entry)
+    return ret
+
+
+def _spec_dependencies(f: pathlib.Path, opts: argparse.Namespace) -> _SpecResult:
+    ret = _SpecResult()
+    _output_dependencies(ret, f, _load_spec(f, opts, ret))
+    return ret
+
+
+def _output_dependencies(ret: _SpecResult, f: pathlib.Path, entry: Entry):
+    deps = " ".join(str(relativized_path(d)) for d in entry.dependencies)
+    ret.output = f"{f}:{deps and ' '}{deps}"
+
+
+def _instrumented(
+    func: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult],
+    f: pathlib.Path,
+    opts: argparse.Namespace,
+) -> _SpecResult:
+    """Run `func` on `f`, collecting any timings, trace events, memory usage or metrics asked for"""
+    if not opts.metrics:
+        return _recorded(func, f, opts)
+    with metrics.collecting() as registry:
+        ret = _recorded(func, f, opts)
+    ret.metrics = registry
+    return ret
+
+
+def _recorded(
+    func: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult],
+    f: pathlib.Path,
+    opts: argparse.Namespace,
+) -> _SpecResult:
+    start = time.perf_counter()
+    if opts.memory_report or opts.timings or opts.trace:
+        if opts.memory_report:
+            # load modules generation needs beforehand, so that they do not show up in the report
+            importlib.import_module(".ctx", __name__)
+            emit.ruamel_yaml()
+            emit.libyaml_available()
+        with (
+            memory.tracing() if opts.memory_report else contextlib.nullcontext(),
+            timings.recording(
+                timed=bool(opts.timings),
+                traced=bool(opts.trace),
+                memory=bool(opts.memory_report),
+            ) as rec,
+            timings.span("spec", file=str(f)),
+            timings.subject(str(f)),
+        ):
+            ret = func(f, opts)
+        ret.times = rec.times
+        ret.events = rec.events or []
+        ret.peaks = rec.peaks
+    else:
+        ret = func(f, opts)
+    ret.elapsed = time.perf_counter() - start
+    return ret
+
+
+def _reusing(
+    reuse: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult | None],
+    func: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult],
+    f: pathlib.Path,
+    opts: argparse.Namespace,
+) -> _SpecResult:
+    ret = reuse(f, opts)
+    return ret if ret is not None else func(f, opts)
+
+
+def _reused(
+    reuse: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult | None],
+    f: pathlib.Path,
+    opts: argparse.Namespace,
+) -> _SpecResult | None:
+    start = time.perf_counter()
+    ret = reuse(f, opts)
+    if ret is not None:
+        ret.elapsed = time.perf_counter() - start
+    return ret
+
+
+def _process_specs(
+    reuse: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult | None],
+    func: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult],
+    files: list[pathlib.Path],
+    opts: argparse.Namespace,
+) -> typing.Iterable[_SpecResult]:
+    """Process `files` with `reuse` if it can do without executing them, and with `func`
+    otherwise"""
+    if min(opts.jobs, len(files)) <= 1:
+        func = functools.partial(
+            _instrumented, functools.partial(_reusing, reuse, func)
+        )
+        yield from (func(f, opts) for f in files)
+        return
+    # cheap checks are done in this process, so that no worker is started if all files pass them
+    reused = [_reused(reuse, f, opts) for f in files]
+    misses = [f for f, r in zip(files, reused) if r is None]
+    jobs = min(opts.jobs, len(misses))
+    func = functools.partial(_instrumented, func)
+    if jobs <= 1:
+        results = (func(f, opts) for f in misses)
+        yield from (r if r is not None else next(results) for r in reused)
+        return
+    import concurrent.futures
+
+    pool = concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=_setup, initargs=(opts,)
+    )
+    with pool:
+        # `map` yields in submission order, which keeps the output deterministic. Results are
+        # yielded as they come rather than collected, so that they can be dropped once processed
+        results = pool.map(func, misses, itertools.repeat(opts))
+        yield from (r if r is not None else next(results) for r in reused)
+
+
+def _scanner(opts: argparse.Namespace) -> Scanner:
+    from .scan import Scanner
+
+    return Scanner(opts.cache_directory and opts.cache_directory / "scan.json")
+
+
+def _declares_workflows(scanner: Scanner, f: pathlib.Path) -> bool:
+    if scanner.scan(f) == []:
+        logging.debug(f"skipping {f}: no workflow declarations")
+        return False
+    return True
+
+
+def _run(
+    reuse: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult | None],
+    func: typing.Callable[[pathlib.Path, argparse.Namespace], _SpecResult],
+    opts: argparse.Namespace,
+    only: typing.Container[pathlib.Path] | None = None,
+) -> int:
+    _setup(opts)
+    inputs = [
+        (i, sorted(f for f in i.glob("*.py") if only is None or f.resolve() in only))
+        for i in opts.inputs or opts.includes
+    ]
+    if opts.scan:
+        scanner = _scanner(opts)
+        inputs = [
+            (i, [f for f in fs if _declares_workflows(scanner, f)]) for i, fs in inputs
+        ]
+        scanner.save()
+    if opts.shard:
+        inputs = _select_shard(inputs, opts)
+    summary = shard.Results(shard=opts.shard)
+    results = iter(
+        _process_specs(reuse, func, [f for _, fs in inputs for f in fs], opts)
+    )
     failed = False
-    found = False
-    for i in inputs:
-        logging.debug(f"@ {i}")
+    writes = {}
+    times = {}
+    events = []
+    profiles = []
+    peaks = {}
+    sites = {}
+    registry = metrics.Registry()
+    # writes happen in this process, and are recorded here if asked to. Otherwise nothing is, as
+    # generation in this process happens within this block as well
+    with (
+        (
+            timings.recording(timed=False, traced=True)
+            if opts.trace
+            else contextlib.nullcontext()
+        ) as rec,
+        metrics.collecting() if opts.metrics else contextlib.nullcontext() as own,
+    ):
+        for i, fs in inputs:
+            logging.debug(f"@ {i}")
+            for f, result in zip(fs, itertools.islice(results, len(fs))):
+                for level, message in result.records:
+                    logging.log(level, message)
+                    if level >= logging.ERROR:
+                        summary.errors.append(message)
+                if result.output is not None:
+                    print(result.output)
+                summary.found |= result.found
+                summary.inputs.append(_shard_key(f))
+                summary.timings[_shard_key(f)] = round(result.elapsed, 6)
+                failed |= result.failed
+                if opts.stream and not result.failed:
+                    _commit(result.writes)
+                else:
+                    writes |= result.writes
+                timings.merge(times, result.times)
+                events += result.events
+                profiles += result.profiles
+                peaks |= result.peaks
+                memory.merge(sites, result.sites)
+                if result.metrics:
+                    registry.merge(result.metrics)
+                    registry.histograms.setdefault(
+                        "spec.seconds", metrics.Histogram()
+                    ).observe(result.elapsed)
+        if opts.timings:
+            print(timings.report(times, opts.timings), file=sys.stderr)
+        if opts.memory_report:
+            print(memory.report(peaks, sites, opts.memory_report), file=sys.stderr)
+        if profiles:
+            report = profiling.aggregate(
+                profiles, opts.profile, opts.includes + opts.inputs, opts.profile_top
+            )
+            print(report, file=sys.stderr)
+            logging.info(f"profiles written to {opts.profile}")
+        summary.exit = _conclude(summary, failed, writes, opts)
+    if opts.metrics:
+        registry.merge(own)
+        registry.save(opts.metrics)
+    if opts.trace:
+        pids = {e["pid"] for e in events} - {os.getpid()}
+        events += rec.events
+        events.append(timings.process_name("gh-gen"))
+        events += (timings.process_name("gh-gen worker") | {"pid": p} for p in pids)
+        timings.save_trace(events, opts.trace)
+    if opts.results:
+        summary.save(opts.results)
+    return summary.exit
+
+
+def _conclude(
+    summary: shard.Results,
+    failed: bool,
+    writes: dict[pathlib.Path, str],
+    opts: argparse.Namespace,
+) -> int:
+    if not summary.found:
+        if opts.shard:
+            # other shards may have found some, which is checked by `merge-results`
+            logging.info(f"no workflows found in shard {opts.shard}")
+            return 0
+        logging.error("no workflows found")
+        return 2
+    if failed:
+        if writes:
+            message = f"{len(writes)} changed workflow(s) not written because of errors"
+            logging.error(message)
+            summary.errors.append(message)
+        return 1
+    _commit(writes)
+    return 0
+
+
+def _shard_key(f: pathlib.Path) -> str:
+    return relativized_path(f).as_posix()
+
+
+def _select_shard(
+    inputs: list[tuple[pathlib.Path, list[pathlib.Path]]], opts: argparse.Namespace
+) -> list[tuple[pathlib.Path, list[pathlib.Path]]]:
+    weights = None
+    if opts.shard_timings:
+        try:
+            weights = shard.load_timings(opts.shard_timings)
+        except (OSError, ValueError) as e:
+            logging.warning(f"ignoring shard timings {opts.shard_timings}: {e}")
+    assignment = shard.assign(
+        (_shard_key(f) for _, fs in inputs for f in fs), opts.shard.total, weights
+    )
+    ret = [
+        (i, [f for f in fs if assignment[_shard_key(f)] == opts.shard.index])
+        for i, fs in inputs
+    ]
+    logging.debug(
+        f"shard {opts.shard}: {sum(len(fs) for _, fs in ret)} of {len(assignment)} input files"
+    )
+    return ret
+
+
+def _git(*args: str) -> str:
+    import subprocess
+
+    return subprocess.run(
+        ["git", *args], check=True, capture_output=True, text=True
+    ).stdout
+
+
+def _changed_files(ref: str) -> set[pathlib.Path]:
+    """Get files changed since `ref`, including uncommitted and untracked ones"""
+    root = pathlib.Path(_git("rev-parse", "--show-toplevel").rstrip("\n"))
+    changed = _git("diff", "--name-only", "-z", ref, "--").split("\0")
+    changed += _git("ls-files", "--others", "--exclude-standard", "-z").split("\0")
+    return {(root / p).resolve() for p in changed if p}
+
+
+def _known_dependencies(
+    f: pathlib.Path, opts: argparse.Namespace
+) -> set[pathlib.Path] | None:
+    """Get the dependencies of `f` at its last generation, without executing it.
+
+    These are taken from the cache if available, or from the output headers otherwise. `None` is
+    returned if they cannot be determined."""
+    entry = opts.cache_directory and Cache(opts.cache_directory).get(f)
+    if entry:
+        return {pathlib.Path(d) for d in entry.dependencies}
+    outputs = _generated_outputs(opts.output_directory).get(f.name)
+    if not outputs:
+        return None
+    ret = set()
+    for output in outputs:
+        with open(output, encoding="utf-8") as out:
+            header = "".join(itertools.islice(out, 3))
+        _, dependencies, _ = fingerprint.parse(header)
+        ret.update((f.parent / d).resolve() for d in dependencies)
+    return ret
+
+
+def _affected_inputs(
+    opts: argparse.Namespace, changed: set[pathlib.Path]
+) -> set[pathlib.Path]:
+    ret = set()
+    for i in opts.inputs or opts.includes:
         for f in i.glob("*.py"):
-            logging.debug(f"← {f}")
-            spec = importlib.util.spec_from_file_location(f.name, str(f))
-            mod = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mod)
-            for k, v in mod.__dict__.items():
-                if isinstance(v, WorkflowInfo):
-                    found = True
-                    try:
-                        output = generate_workflow(
-                            v, opts.output_directory, check=opts.check
-                        )
-                        logging.info(f"{'✅' if opts.check else '→'} {output}")
-                    except (GenerationError, DiffError) as e:
-                        failed = True
-                        for error in e.errors:
-                            logging.error(error)
+            resolved = f.resolve()
+            outputs = _generated_outputs(opts.output_directory).get(f.name, ())
+            dependencies = _known_dependencies(f, opts)
+            if (
+                resolved in changed
+                or dependencies is None
+                or dependencies & changed
+                or any(o.resolve() in changed for o in outputs)
+            ):
+                ret.add(resolved)
+    return ret
+
+
+def generate(opts: argparse.Namespace):
+    only = None
+    if opts.changed_since:
+        import subprocess
+
+        _setup(opts)
+        try:
+            changed = _changed_files(opts.changed_since)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"cannot get changes since {opts.changed_since}:")
+            logging.error(e.stderr.strip())
+            return 1
+        only = _affected_inputs(opts, changed)
+        if not only:
+            logging.info(f"no workflows affected by changes since {opts.changed_since}")
+            return 0
+    return _run(_reuse_outputs, _generate_spec, opts, only)
+
+
+def list_dependencies(opts: argparse.Namespace):
+    return _run(_reuse_dependencies, _spec_dependencies, opts)
+
+
+def list_workflows(opts: argparse.Namespace):
+    scanner = _scanner(opts)
+    found = False
+    for i in opts.inputs or opts.includes:
+        for f in sorted(i.glob("*.py")):
+            decls = scanner.scan(f)
+            if decls is None:
+                logging.warning(f"cannot parse {f}")
+                continue
+            for d in decls:
+                found = True
+                output = d.id and workflow_output(opts.output_directory, d.id)
+                print(f"{d.id or '?'} {f}:{d.lineno} {output or '?'}")
+    scanner.save()
     if not found:
         logging.error("no workflows found")
         return 2
-    if failed:
+    return 0
+
+
+def merge_results(opts: argparse.Namespace):
+    import argparse
+    import json
+
+    try:
+        results = [shard.Results.load(f) for f in opts.results_files]
+    except (OSError, ValueError, TypeError, argparse.ArgumentTypeError) as e:
+        logging.error(f"cannot load results: {e}")
         return 1
+    merged = shard.merge(results)
+    for error in merged.errors:
+        logging.error(error)
+    if opts.timings:
+        with open(opts.timings, "w") as out:
+            json.dump(merged.timings, out, indent=2, sort_keys=True)
+            out.write("\n")
+    if not merged.errors:
+        logging.info(
+            f"{len(results)} shard(s) processed {len(merged.inputs)} input file(s) successfully"
+        )
+    return merged.exit
+
+
+def _shared_cache(opts: argparse.Namespace) -> SharedCache | None:
+    dir = opts.directory or os.environ.get(shared_dir_env_var)
+    if not dir:
+        logging.error(
+            f"no shared cache directory, set `${shared_dir_env_var}` or use `--directory`"
+        )
+        return None
+    return SharedCache(pathlib.Path(dir))
+
+
+def cache_stats(opts: argparse.Namespace):
+    shared = _shared_cache(opts)
+    if shared is None:
+        return 2
+    stats = shared.stats()
+    rows = [
+        ["directory", str(shared.dir)],
+        ["manifests", str(stats.manifests)],
+        ["objects", str(stats.objects)],
+        ["size", memory.format_size(stats.size)],
+    ]
+    if stats.oldest is not None:
+        days = (time.time() - stats.oldest) / 86400
+        rows.append(["least recently used", f"{days:.1f} days ago"])
+    print(timings.table(rows))
+    return 0
+
+
+def cache_prune(opts: argparse.Namespace):
+    shared = _shared_cache(opts)
+    if shared is None:
+        return 2
+    if opts.max_size is None and opts.max_age is None:
+        logging.error("nothing to prune, use `--max-size` and/or `--max-age`")
+        return 2
+    removed, freed = shared.prune(opts.max_size, opts.max_age)
+    logging.info(
+        f"removed {removed} file(s) ({memory.format_size(freed)}) from {shared.dir}"
+    )
     return 0
 
 
+def _regenerate(opts: argparse.Namespace, changed: set[pathlib.Path]) -> int | None:
+    """Regenerate workflows affected by `changed` files in this same process"""
+    from .ctx import _ctx
+
+    affected = invalidate(changed)
+    inputs = {f.resolve() for i in opts.inputs or opts.includes for f in i.glob("*.py")}
+    affected &= inputs
+    if not affected:
+        logging.debug("no input affected")
+        return None
+    _ctx.reset()
+    try:
+        return _run(_reuse_outputs, _generate_spec, opts, only=affected)
+    except Exception:
+        logging.exception("generation failed")
+        return None
+    finally:
+        # make sure nothing is left over by failed generations
+        _ctx.reset()
+        gc.collect()
+
+
+def watch_workflows(opts: argparse.Namespace):
+    # we want to keep modules loaded across regenerations, so no worker processes
+    opts.jobs = 1
+    from .watch import watcher as file_watcher
+
+    dirs = [*opts.includes, *opts.inputs]
+    watcher = file_watcher(dirs, poll=opts.poll)
+    logging.info(f"watching {', '.join(map(str, dirs))} ({type(watcher).__name__})")
+    try:
+        try:
+            generate(opts)
+        except Exception:
+            logging.exception("generation failed")
+        while True:
+            changed = watcher.wait()
+            logging.debug(f"changed: {', '.join(map(str, sorted(changed)))}")
+            _regenerate(opts, changed)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def _serve_request(args: list[str]) -> int:
+    discover_workflows_dir.cache_clear()
+    opts = options(args)
+    logging.getLogger().setLevel(logging.INFO if not opts.verbose else logging.DEBUG)
+    logging.debug(opts.__dict__)
+    if opts.command in (serve, watch_workflows):
+        logging.error("this command cannot be run through a server")
+        return 2
+    return opts.command(opts)
+
+
+def serve(opts: argparse.Namespace):
+    path = opts.socket
+    if path is None and socket_env_var in os.environ:
+        path = pathlib.Path(os.environ[socket_env_var])
+    if path is None:
+        cache_directory = opts.cache_directory or (
+            opts.output_directory.parent / default_cache_dir_name
+        )
+        path = cache_directory / default_socket_name
+    from .server import make_server
+
+    server = make_server(path, _serve_request)
+    logging.info(f"serving on {path}")
+    try:
+        with server:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        path.unlink(missing_ok=True)
+
+
 def options(args: typing.Sequence[str] = None):
+    import argparse
+
     p = argparse.ArgumentParser(description="Generate Github Actions workflows")
 
     def common_opts(parser):
@@ -137,6 +1001,133 @@ def options(args: typing.Sequence[str] = None):
             type=relativized_path,
         )
         parser.add_argument("--check", "-C", action="store_true")
+        parser.add_argument(
+            "--strict",
+            action="store_true",
+            help="Always regenerate workflows, rather than relying on output fingerprints (with `--check`) or the cache",
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            metavar="N",
+            default=os.cpu_count() or 1,
+            help="Number of processes to spread input files over (CPU count by default)",
+        )
+        parser.add_argument(
+            "--cache-directory",
+            type=relativized_path,
+            metavar="DIR",
+            help=f"Where to cache generated workflows (`{default_cache_dir_name}` next to the output directory by default)",
+        )
+        parser.add_argument(
+            "--shared-cache-directory",
+            type=relativized_path,
+            metavar="DIR",
+            help=f"Also use a content-addressable cache in DIR (`${shared_dir_env_var}` by default), which can be shared across checkouts and machines, for example persisting it in CI",
+        )
+        parser.add_argument(
+            "--changed-since",
+            metavar="REF",
+            help="Only process input files affected by changes since the git reference REF (including uncommitted ones). Input files are affected by changes to themselves, to files they import or to their outputs",
+        )
+        parser.add_argument(
+            "--shard",
+            type=shard.parse,
+            metavar="INDEX/TOTAL",
+            help="Only process the INDEX-th (starting from 1) of TOTAL deterministic partitions of the input files, for splitting work across runners",
+        )
+        parser.add_argument(
+            "--shard-timings",
+            type=pathlib.Path,
+            metavar="FILE",
+            help="Balance shards using the input file generation times in FILE, as written by `merge-results --timings`. All shards must use the same FILE",
+        )
+        parser.add_argument(
+            "--results",
+            type=pathlib.Path,
+            metavar="FILE",
+            help="Write a summary of the run to FILE, to be combined across shards with `merge-results`",
+        )
+        parser.add_argument(
+            "--timings",
+            type=int,
+            nargs="?",
+            const=10,
+            metavar="N",
+            help="Print how much wall and CPU time was spent in each generation phase, overall and for the N (10 by default) slowest workflows. This implies `--strict`",
+        )
+        parser.add_argument(
+            "--trace",
+            type=pathlib.Path,
+            metavar="FILE",
+            help="Write a trace of the run to FILE in the Chrome Trace Event format, to be loaded in Perfetto or chrome://tracing. This implies `--strict`",
+        )
+        parser.add_argument(
+            "--metrics",
+            type=pathlib.Path,
+            metavar="FILE",
+            help="Write internal counters and histograms (created expressions, validations, cache hits, bytes written...) to FILE as JSON",
+        )
+        parser.add_argument(
+            "--memory-report",
+            type=int,
+            nargs="?",
+            const=10,
+            metavar="N",
+            help="Trace memory allocations, printing peak memory per generation phase and for the N (10 by default) largest workflows, and the N sites allocating the most memory in ghgen, spec code and elsewhere. This implies `--strict`",
+        )
+        parser.add_argument(
+            "--profile",
+            type=relativized_path,
+            nargs="?",
+            const=True,
+            metavar="DIR",
+            help=f"Profile the generation of each workflow, writing `.pstats` files for each of them and `{profiling.aggregate_name}` for all of them in DIR (`profile` in the cache directory by default), and printing the functions with the most cumulative time. This implies `--strict`",
+        )
+        parser.add_argument(
+            "--profile-top",
+            type=int,
+            default=20,
+            metavar="N",
+            help="Number of functions to print for each of ghgen, spec code and the rest with `--profile` (20 by default)",
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Write and forget the workflows of each input file as soon as it is processed, so that memory does not grow with the number of workflows. Outputs of input files without errors are then written even if other input files have errors",
+        )
+        parser.add_argument(
+            "--emitter",
+            choices=emit.backends,
+            default="auto",
+            help="YAML emitter to use: `libyaml` is faster but requires `ruamel.yaml.clib`, `auto` (the default) uses it if available. Workflows `libyaml` might format differently are always written with `ruamel`, so that output does not depend on this",
+        )
+        parser.add_argument(
+            "--format",
+            choices=emit.formats,
+            default="yaml",
+            help="Output format: `json` is written in a single line, and is much faster to produce. As JSON is valid YAML, outputs keep the `.yml` extension GitHub requires, with header comments in YAML syntax before the JSON body",
+        )
+        parser.add_argument(
+            "--anchors",
+            type=int,
+            nargs="?",
+            const=200,
+            metavar="SIZE",
+            help="Write blocks repeated within a workflow once as YAML anchors, and as aliases elsewhere, if at least SIZE long (200 by default) in compact JSON. Blocks with comments are never aliased, and merge keys are not used, as GitHub does not support them. Bytes saved are reported for each workflow",
+        )
+        parser.add_argument(
+            "--no-scan",
+            action="store_false",
+            dest="scan",
+            help="Execute all input files, rather than only the ones that declare workflows with `@workflow` or `workflow(...)`",
+        )
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Neither use nor update caches, always executing input files",
+        )
 
     common_opts(p)
     p.set_defaults(command=generate)
@@ -146,17 +1137,134 @@ def options(args: typing.Sequence[str] = None):
     )
     gen.set_defaults(command=generate)
     common_opts(gen)
-    ret = p.parse_args(args)
+    deps_parser = commands.add_parser(
+        "deps",
+        help="print the files each input file depends on, in Makefile syntax",
+    )
+    deps_parser.set_defaults(command=list_dependencies)
+    common_opts(deps_parser)
+    list_parser = commands.add_parser(
+        "list",
+        aliases=["ls"],
+        help="list declared workflows with their location and output, without executing anything",
+    )
+    list_parser.set_defaults(command=list_workflows)
+    common_opts(list_parser)
+    watch_parser = commands.add_parser(
+        "watch",
+        aliases=["w"],
+        help="watch input and include directories, regenerating workflows on changes",
+    )
+    watch_parser.set_defaults(command=watch_workflows)
+    common_opts(watch_parser)
+    watch_parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Poll for changes rather than relying on inotify",
+    )
+    merge_parser = commands.add_parser(
+        "merge-results",
+        help="combine the `--results` of all shards of a run, exiting with the overall status",
+    )
+    merge_parser.set_defaults(command=merge_results)
+    merge_parser.add_argument("--verbose", "-v", action="store_true")
+    merge_parser.add_argument(
+        "--timings",
+        type=pathlib.Path,
+        metavar="FILE",
+        help="Write the generation time of each input file to FILE, for use with `--shard-timings`",
+    )
+    merge_parser.add_argument(
+        "results_files", nargs="+", type=pathlib.Path, metavar="RESULTS"
+    )
+    serve_parser = commands.add_parser(
+        "serve",
+        help=f"serve requests from `gh-gen-client`, keeping a warm process",
+    )
+    serve_parser.set_defaults(command=serve)
+    common_opts(serve_parser)
+    serve_parser.add_argument(
+        "--socket",
+        type=pathlib.Path,
+        metavar="PATH",
+        help=f"Unix socket to listen on (`${socket_env_var}` or `{default_socket_name}` in the cache directory by default)",
+    )
+    cache_parser = commands.add_parser(
+        "cache",
+        help="inspect or prune the shared cache",
+    )
+    cache_parser.add_argument("--verbose", "-v", action="store_true")
+    cache_parser.add_argument(
+        "--directory",
+        type=relativized_path,
+        metavar="DIR",
+        help=f"Shared cache directory (`${shared_dir_env_var}` by default)",
+    )
+    cache_commands = cache_parser.add_subparsers(required=True)
+    cache_commands.add_parser(
+        "stats", help="print the number of entries and size of the shared cache"
+    ).set_defaults(command=cache_stats)
+    prune_parser = cache_commands.add_parser(
+        "prune", help="remove least recently used shared cache entries"
+    )
+    prune_parser.set_defaults(command=cache_prune)
+    prune_parser.add_argument(
+        "--max-size",
+        type=parse_size,
+        metavar="SIZE",
+        help="Remove entries until the cache takes at most SIZE bytes (with an optional K, M or G suffix)",
+    )
+    prune_parser.add_argument(
+        "--max-age",
+        type=parse_age,
+        metavar="AGE",
+        help="Remove entries not used for more than AGE seconds (with an optional s, m, h or d suffix)",
+    )
+    args = sys.argv[1:] if args is None else list(args)
+    if args and args[0] in commands.choices:
+        # parse directly with the subcommand, as otherwise top-level `inputs` would swallow
+        # subcommand positional arguments
+        ret = commands.choices[args[0]].parse_args(args[1:])
+    else:
+        ret = p.parse_args(args)
     if not ret.command:
         p.print_help()
         sys.exit(0)
+    if ret.command in (merge_results, cache_stats, cache_prune):
+        return ret
     ret.output_directory = ret.output_directory or discover_workflows_dir()
     ret.includes = ret.includes or [discover_workflows_dir()]
+    if ret.no_cache:
+        ret.cache_directory = None
+        ret.shared_cache_directory = None
+    else:
+        if ret.shared_cache_directory is None and os.environ.get(shared_dir_env_var):
+            ret.shared_cache_directory = pathlib.Path(os.environ[shared_dir_env_var])
+        ret.cache_directory = ret.cache_directory or (
+            ret.output_directory.parent / default_cache_dir_name
+        )
+    if ret.anchors is not None and ret.format == "json":
+        p.error("`--anchors` cannot be used with `--format json`")
+    if ret.emitter == "libyaml" and not emit.libyaml_available():
+        p.error("`--emitter libyaml` requires `ruamel.yaml.clib`")
+    if ret.timings or ret.trace or ret.memory_report:
+        # so that there is something to report for all files
+        ret.strict = True
+    if ret.profile:
+        if ret.profile is True:
+            ret.profile = (
+                ret.cache_directory
+                or ret.output_directory.parent / default_cache_dir_name
+            ) / "profile"
+        ret.profile.mkdir(parents=True, exist_ok=True)
+        ret.strict = True
     return ret
 
 
 def main(args: typing.Sequence[str] = None) -> int:
     opts = options(args)
+    import colorlog
+
     handler = colorlog.StreamHandler()
     handler.setFormatter(
         colorlog.ColoredFormatter(
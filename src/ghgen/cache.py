@@ -0,0 +1,280 @@
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import sys
+import time
+import typing
+
+default_dir_name = ".ghgen-cache"
+shared_dir_env_var = "GHGEN_SHARED_CACHE"
+
+
+@functools.cache
+def ghgen_version() -> str:
+    # `importlib.metadata` is slow to import, and not needed on all code paths
+    import importlib.metadata
+
+    try:
+        return importlib.metadata.version("ghgen")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+@functools.cache
+def _sources_digest() -> str:
+    # also hash our own sources, so that cached entries from development versions are told apart
+    h = hashlib.sha256()
+    for source in sorted(pathlib.Path(__file__).parent.glob("*.py")):
+        h.update(source.read_bytes())
+    return h.hexdigest()
+
+
+def file_digest(path: pathlib.Path) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def ensure_dir(dir: pathlib.Path):
+    if not dir.exists():
+        dir.mkdir(parents=True, exist_ok=True)
+        (dir / ".gitignore").write_text("*\n")
+
+
+def _read_json(path: pathlib.Path) -> typing.Any:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path: pathlib.Path, data: typing.Any):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # caches can be written concurrently by worker processes, or by other machines when shared,
+    # make it atomic
+    tmp = path.with_suffix(f".{os.getpid()}-{os.urandom(4).hex()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    tmp.replace(path)
+
+
+@dataclasses.dataclass
+class Entry:
+    key: str
+    # workflow id -> generated text
+    workflows: dict[str, str] = dataclasses.field(default_factory=dict)
+    # dependency path -> digest
+    dependencies: dict[str, str] = dataclasses.field(default_factory=dict)
+
+    def is_up_to_date(self) -> bool:
+        try:
+            return all(
+                file_digest(pathlib.Path(d)) == digest
+                for d, digest in self.dependencies.items()
+            )
+        except OSError:
+            return False
+
+
+@dataclasses.dataclass(frozen=True)
+class Cache:
+    """Persistent cache of generated workflows, one entry per input file.
+
+    Entries are only valid as long as the contents of the input file and of all the files it
+    depends on, the `ghgen` version, the python version and the output options are unchanged.
+    """
+
+    dir: pathlib.Path
+    # options changing generated text, like the output format
+    output_options: str = "yaml"
+
+    def key(self, input: pathlib.Path) -> str:
+        h = hashlib.sha256()
+        h.update(f"{ghgen_version()}\0{_sources_digest()}\0{sys.version}\0".encode())
+        h.update(f"{self.output_options}\0{file_digest(input)}".encode())
+        return h.hexdigest()
+
+    def _entry_path(self, input: pathlib.Path) -> pathlib.Path:
+        name = hashlib.sha256(str(input.resolve()).encode()).hexdigest()
+        return self.dir / f"{name}.json"
+
+    def get(self, input: pathlib.Path, key: str | None = None) -> Entry | None:
+        """Get the entry for `input`, if any.
+
+        If `key` is provided, only an up to date entry matching it is returned."""
+        try:
+            with open(self._entry_path(input)) as f:
+                entry = Entry(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+        if key is not None and (entry.key != key or not entry.is_up_to_date()):
+            return None
+        return entry
+
+    def put(self, input: pathlib.Path, entry: Entry):
+        ensure_dir(self.dir)
+        _write_json(self._entry_path(input), dataclasses.asdict(entry))
+
+
+@dataclasses.dataclass
+class Stats:
+    manifests: int = 0
+    objects: int = 0
+    size: int = 0
+    # modification time of the least recently used file
+    oldest: float | None = None
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedCache:
+    """Content-addressable cache of generated workflows, meant to be shared across checkouts and
+    machines.
+
+    As the dependencies of an input file are only known after executing it, lookups go through a
+    manifest keyed by the name and contents of the input file, by the `ghgen` and python versions
+    and by the output options. Manifests list the dependencies seen for that key along with their
+    digests, and generated workflows are stored under a hash of the key and of those digests.
+    Dependencies are recorded relative to the input file, so that checkouts in different locations
+    share entries.
+    """
+
+    dir: pathlib.Path
+    # options changing generated text, like the output format
+    output_options: str = "yaml"
+    # dependency sets remembered for each manifest, most recent first
+    max_variants: typing.ClassVar[int] = 8
+
+    def key(self, input: pathlib.Path) -> str:
+        h = hashlib.sha256()
+        h.update(f"{ghgen_version()}\0{_sources_digest()}\0{sys.version}\0".encode())
+        h.update(f"{self.output_options}\0{input.name}\0{file_digest(input)}".encode())
+        return h.hexdigest()
+
+    def _path(self, kind: str, key: str) -> pathlib.Path:
+        return self.dir / kind / key[:2] / f"{key}.json"
+
+    def _object_path(self, key: str, dependencies: dict[str, str]) -> pathlib.Path:
+        h = hashlib.sha256(key.encode())
+        for d, digest in sorted(dependencies.items()):
+            h.update(f"\0{d}\0{digest}".encode())
+        return self._path("objects", h.hexdigest())
+
+    def get(self, input: pathlib.Path) -> Entry | None:
+        key = self.key(input)
+        manifest = self._path("manifests", key)
+        for dependencies in _read_json(manifest) or ():
+            try:
+                if any(
+                    file_digest(input.parent / d) != digest
+                    for d, digest in dependencies.items()
+                ):
+                    continue
+            except OSError:
+                continue
+            stored = self._object_path(key, dependencies)
+            workflows = _read_json(stored)
+            if workflows is None:
+                continue
+            # keep track of usage for pruning, which is best effort: the cache may be read-only, or
+            # pruned concurrently
+            with contextlib.suppress(OSError):
+                for path in (manifest, stored):
+                    os.utime(path)
+            return Entry(
+                key,
+                workflows,
+                {
+                    str((input.parent / d).resolve()): digest
+                    for d, digest in dependencies.items()
+                },
+            )
+        return None
+
+    def put(self, input: pathlib.Path, entry: Entry):
+        ensure_dir(self.dir)
+        key = self.key(input)
+        parent = input.resolve().parent
+        dependencies = {
+            pathlib.Path(os.path.relpath(d, parent)).as_posix(): digest
+            for d, digest in entry.dependencies.items()
+        }
+        _write_json(self._object_path(key, dependencies), entry.workflows)
+        # concurrent updates of the same manifest may lose variants, which only costs cache misses
+        manifest = self._path("manifests", key)
+        variants = [v for v in _read_json(manifest) or () if v != dependencies]
+        _write_json(manifest, [dependencies, *variants][: self.max_variants])
+
+    def _files(self) -> list[tuple[pathlib.Path, os.stat_result]]:
+        ret = []
+        for kind in ("manifests", "objects"):
+            for path in (self.dir / kind).glob("*/*"):
+                try:
+                    ret.append((path, path.stat()))
+                except OSError:
+                    # removed concurrently
+                    pass
+        return ret
+
+    def stats(self) -> Stats:
+        ret = Stats()
+        for path, st in self._files():
+            match path.relative_to(self.dir).parts[0]:
+                case "manifests":
+                    ret.manifests += 1
+                case "objects":
+                    ret.objects += 1
+            ret.size += st.st_size
+            ret.oldest = min(ret.oldest or st.st_mtime, st.st_mtime)
+        return ret
+
+    def prune(
+        self, max_size: int | None = None, max_age: float | None = None
+    ) -> tuple[int, int]:
+        """Remove least recently used files until the cache is at most `max_size` bytes, and files
+        not used for more than `max_age` seconds, returning the number of removed files and their
+        total size"""
+        files = sorted(self._files(), key=lambda f: f[1].st_mtime)
+        size = sum(st.st_size for _, st in files)
+        now = time.time()
+        removed = freed = 0
+        for path, st in files:
+            too_big = max_size is not None and size > max_size
+            too_old = max_age is not None and now - st.st_mtime > max_age
+            if not (too_big or too_old):
+                # files are sorted by usage, so later ones are not to be removed either
+                break
+            path.unlink(missing_ok=True)
+            size -= st.st_size
+            removed += 1
+            freed += st.st_size
+        return removed, freed
+
+
+_size_units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+_age_units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def _parse_quantity(value: str, units: dict[str, int], example: str) -> int:
+    import argparse
+    import re
+
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([a-zA-Z]?)", value)
+    if not m or m[2] not in units:
+        raise argparse.ArgumentTypeError(
+            f"expected something like {example}, got {value!r}"
+        )
+    return int(float(m[1]) * units[m[2]])
+
+
+def parse_size(value: str) -> int:
+    """Parse a size in bytes with an optional K, M or G suffix, as an `argparse` type"""
+    return _parse_quantity(value.upper(), _size_units, "500M or 2G")
+
+
+def parse_age(value: str) -> int:
+    """Parse an age in seconds with an optional s, m, h or d suffix, as an `argparse` type"""
+    return _parse_quantity(value.lower(), _age_units, "12h or 30d")
@@ -0,0 +1,75 @@
+# Thin client forwarding `gh-gen` invocations to a `gh-gen serve` server.
+# This is meant to start fast, so it must only import lightweight standard modules. If no server is
+# reachable, it falls back to running `gh-gen` in process.
+
+import json
+import os
+import pathlib
+import socket
+import sys
+import typing
+
+socket_env_var = "GHGEN_SOCKET"
+default_socket_name = "server.sock"
+
+_levels = {10: "DEBUG", 20: "INFO", 30: "WARNING", 40: "ERROR", 50: "CRITICAL"}
+_colors = {10: "37", 20: "32", 30: "33", 40: "31", 50: "1;31"}
+
+
+def default_socket() -> pathlib.Path | None:
+    """Find the server socket, mirroring how `gh-gen` discovers the output directory"""
+    env = os.environ.get(socket_env_var)
+    if env:
+        return pathlib.Path(env)
+    cwd = pathlib.Path.cwd()
+    for dir in (cwd, *cwd.parents):
+        if dir.joinpath(".github").exists() or dir.joinpath(".git").exists():
+            return dir / ".github" / ".ghgen-cache" / default_socket_name
+    return None
+
+
+def _log(level: int, message: str):
+    name = _levels.get(level, str(level))
+    if sys.stderr.isatty():
+        color = _colors.get(level, "0")
+        print(f"\033[{color}m{name: <8}\033[0m {message}", file=sys.stderr)
+    else:
+        print(f"{name: <8} {message}", file=sys.stderr)
+
+
+def _connect(path: pathlib.Path | None) -> socket.socket | None:
+    if path is None:
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(str(path))
+    except OSError:
+        s.close()
+        return None
+    return s
+
+
+def main(args: typing.Sequence[str] = None) -> int:
+    args = sys.argv[1:] if args is None else list(args)
+    s = _connect(default_socket())
+    if s is None:
+        from . import main as local_main
+
+        return local_main(args)
+    with s, s.makefile("rwb") as stream:
+        request = {"argv": args, "cwd": os.getcwd()}
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            match message:
+                case {"exit": int() as code}:
+                    return code
+                case {"log": int() as level, "message": str() as text}:
+                    _log(level, text)
+                case {"out": str() as text}:
+                    sys.stdout.write(text)
+                case {"err": str() as text}:
+                    sys.stderr.write(text)
+    _log(40, "connection to gh-gen server lost")
+    return 1
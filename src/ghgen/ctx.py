@@ -7,8 +7,6 @@ import typing
 from dataclasses import dataclass, fields, asdict
 import pathlib
 
-import inflection
-
 from .expr import (
     Expr,
     on_error,
@@ -20,7 +18,7 @@ from .expr import (
     reftree,
     CallExpr,
 )
-from . import workflow, element
+from . import workflow, element, timings, metrics
 from .contexts import *
 
 
@@ -38,16 +36,20 @@ class Error:
 _this_dir = pathlib.Path(__file__).parent
 
 
+def _is_internal(filename: str) -> bool:
+    # contextlib wraps some of our functions
+    return (
+        pathlib.Path(filename).is_relative_to(_this_dir)
+        or filename == contextlib.__file__
+    )
+
+
 def _get_user_frame() -> typing.Any:
     frame = inspect.currentframe()
 
     for frame in iter(lambda: frame.f_back, None):
-        filename = frame.f_code.co_filename
-        # get first frame out of this app or contextlib (that wraps some of our functions)
-        if not (
-            pathlib.Path(filename).is_relative_to(_this_dir)
-            or filename == contextlib.__file__
-        ):
+        # get first frame out of this app
+        if not _is_internal(frame.f_code.co_filename):
             break
     return frame
 
@@ -88,6 +90,7 @@ class _Context(ContextBase):
         )
 
     def error(self, message: str):
+        metrics.count("errors")
         error = self.make_error(message)
         if self.current_workflow:
             self.errors.append(error)
@@ -137,6 +140,7 @@ class _Context(ContextBase):
         previous_job_id = self.current_job_id
         job = Job()
         self.reset_job(job, id)
+        span = timings.span("job", job=id, workflow=self.current_workflow_id)
         try:
             if self.auto_job_reason:
                 self.error(
@@ -150,7 +154,8 @@ class _Context(ContextBase):
                 )
             else:
                 self.current_workflow.jobs[id] = job
-            yield job
+            with span:
+                yield job
         finally:
             self.reset_job(previous_job, previous_job_id)
 
@@ -649,6 +654,7 @@ def current_workflow_id() -> str | None:
 
 
 def _merge[T](field: str, lhs: T | None, rhs: T | None, recursed=False) -> T | None:
+    metrics.count("ctx.merge")
     try:
         match (lhs, rhs):
             case None, _:
@@ -707,13 +713,20 @@ class WorkflowInfo:
     @property
     def worfklow(self) -> Workflow:
         if self._workflow is None:
-            with _ctx.build_workflow(self.id) as self._workflow:
+            with (
+                timings.phase("build", workflow=self.id, file=str(self.file)),
+                _ctx.build_workflow(self.id) as self._workflow,
+            ):
                 for e in self.errors:
                     e.workflow_id = e.workflow_id or current_workflow_id()
                 _ctx.errors += self.errors
                 self.spec()
         return self._workflow
 
+    def release(self):
+        """Drop the built workflow, so that its memory can be reclaimed"""
+        self._workflow = None
+
 
 def workflow(
     func: typing.Callable[..., None] | None = None, *, id=None
@@ -965,6 +978,8 @@ class _StepUpdater(ProxyExpr):
         _ctx.validate(source, target=ret._step, field="uses")
         ret._step.uses = source
         if isinstance(source, str) and not ret._step.name:
+            import inflection
+
             try:
                 _, _, action_name = source.rpartition("/")
                 action_name, _, _ = action_name.partition("@")
@@ -0,0 +1,158 @@
+import builtins
+import contextlib
+import importlib.util
+import pathlib
+import sys
+import typing
+
+# import edges between user files recorded so far in this process. As modules are executed only
+# once per process, this must be kept across tracked inputs for dependencies to be transitive
+_imports: dict[pathlib.Path, set[pathlib.Path]] = {}
+# `__import__` as it is without tracking, while within `track_imports`
+_untracked_import: typing.Callable[..., typing.Any] | None = None
+
+
+def _file(module: typing.Any) -> pathlib.Path | None:
+    file = getattr(module, "__file__", None)
+    return file and pathlib.Path(file).resolve()
+
+
+def _imported_modules(
+    name: str, globals: dict | None, fromlist: typing.Sequence[str] | None, level: int
+) -> typing.Generator[typing.Any, None, None]:
+    if level:
+        try:
+            name = importlib.util.resolve_name(
+                "." * level + name, (globals or {}).get("__package__")
+            )
+        except (ImportError, ValueError):
+            return
+    parts = name.split(".")
+    names = [".".join(parts[:i]) for i in range(1, len(parts) + 1)]
+    names += [f"{name}.{x}" for x in fromlist or () if x != "*"]
+    for n in names:
+        module = sys.modules.get(n)
+        if module is not None:
+            yield module
+
+
+@contextlib.contextmanager
+def track_imports(
+    input: pathlib.Path, roots: typing.Iterable[pathlib.Path]
+) -> typing.Generator[set[pathlib.Path], None, None]:
+    """Track the user files `input` depends on while executing the body of this context manager.
+
+    User files are the ones found under any of `roots`. The yielded set is filled in with all
+    (transitive) dependencies when exiting."""
+    roots = [r.resolve() for r in roots]
+    input = input.resolve()
+    deps = set()
+    # `__file__` -> resolved path if a user file, `None` otherwise, as imports are frequent
+    user_files: dict[str, pathlib.Path | None] = {}
+    # (importer, name, fromlist, level) of imports whose edges were already recorded
+    recorded = set()
+
+    def user_path(file: str | None) -> pathlib.Path | None:
+        if not file:
+            return None
+        ret = user_files.get(file, ...)
+        if ret is ...:
+            path = pathlib.Path(file).resolve()
+            ret = user_files[file] = (
+                path if any(path.is_relative_to(r) for r in roots) else None
+            )
+        return ret
+
+    def user_file(module: typing.Any) -> pathlib.Path | None:
+        return user_path(getattr(module, "__file__", None))
+
+    original_import = builtins.__import__
+
+    def tracking_import(name, globals=None, locals=None, fromlist=(), level=0):
+        ret = original_import(name, globals, locals, fromlist, level)
+        importer = globals and user_path(globals.get("__file__"))
+        if not importer:
+            return ret
+        key = (importer, name, tuple(fromlist or ()), level)
+        if key in recorded:
+            return ret
+        recorded.add(key)
+        for module in _imported_modules(name, globals, fromlist, level):
+            file = user_file(module)
+            if file and file != importer:
+                _imports.setdefault(importer, set()).add(file)
+        return ret
+
+    global _untracked_import
+    previous = _untracked_import
+    before = set(sys.modules)
+    builtins.__import__ = tracking_import
+    _untracked_import = original_import
+    try:
+        yield deps
+    finally:
+        builtins.__import__ = original_import
+        _untracked_import = previous
+        # anything loaded in the meantime (including through `importlib`) is a dependency
+        direct = _imports.setdefault(input, set())
+        for name in set(sys.modules) - before:
+            file = user_file(sys.modules[name])
+            if file:
+                direct.add(file)
+        todo = [input]
+        while todo:
+            for dep in _imports.get(todo.pop(), ()):
+                if dep not in deps and dep != input:
+                    deps.add(dep)
+                    todo.append(dep)
+
+
+@contextlib.contextmanager
+def untracked() -> typing.Generator[None, None, None]:
+    """Do not track imports within the body, when within `track_imports`.
+
+    Modules loaded meanwhile are still dependencies, but imports of already loaded ones are not
+    looked into, which makes them quicker."""
+    if _untracked_import is None:
+        yield
+        return
+    tracking_import = builtins.__import__
+    builtins.__import__ = _untracked_import
+    try:
+        yield
+    finally:
+        builtins.__import__ = tracking_import
+
+
+def record(input: pathlib.Path, dependencies: typing.Iterable[pathlib.Path]):
+    """Record that `input` depends on `dependencies` without executing it, for example when its
+    workflows are taken from a cache"""
+    _imports.setdefault(input.resolve(), set()).update(
+        d.resolve() for d in dependencies
+    )
+
+
+def invalidate(files: typing.Iterable[pathlib.Path]) -> set[pathlib.Path]:
+    """Forget about `files` and all files that (transitively) import them, returning them all.
+
+    Loaded modules for these files are removed from `sys.modules`, so that they are executed anew
+    when next imported."""
+    todo = [f.resolve() for f in files]
+    ret = set(todo)
+    while todo:
+        f = todo.pop()
+        for importer, imported in _imports.items():
+            if f in imported and importer not in ret:
+                ret.add(importer)
+                todo.append(importer)
+    for name, module in list(sys.modules.items()):
+        if _file(module) in ret:
+            del sys.modules[name]
+    for f in ret:
+        _imports.pop(f, None)
+    return ret
+
+
+def reset():
+    """Forget about all recorded imports"""
+    _imports.clear()
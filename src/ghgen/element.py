@@ -1,12 +1,22 @@
 import dataclasses
 import typing
+import weakref
 
+from ruamel.yaml.comments import CommentedMap, CommentedSeq
+
+from . import metrics
 from .expr import Expr, instantiate
 
 
 @dataclasses.dataclass
 class Element:
     _preserve_underscores: typing.ClassVar[bool] = False
+    # output keys of fields to write in YAML flow style
+    _flow_style: typing.ClassVar[tuple[str, ...]] = ()
+    # set for each subclass by `__init_subclass__`: (attribute, output key) pairs of fields, and
+    # the function serializing them
+    _fields: typing.ClassVar[list[tuple[str, str]]] = []
+    _serialize: typing.ClassVar[typing.Callable[[typing.Self], dict]]
 
     @classmethod
     def _key(cls, key: str) -> str:
@@ -16,13 +26,25 @@ class Element:
         return key
 
     def asdict(self) -> typing.Any:
-        return {
-            self._key(k): asobj(v)
-            for k, v in (
-                (f.name, getattr(self, f.name)) for f in dataclasses.fields(self)
-            )
-            if v is not None
-        }
+        return self._serialize()
+
+    def __setattr__(self, name: str, value: typing.Any):
+        # elements have no setters, which makes this quicker than `object.__setattr__`, and this
+        # is called for each field on construction
+        d = self.__dict__
+        d[name] = value
+        if "_serialized" in d:
+            self._invalidate()
+
+    def _invalidate(self):
+        """Drop the serialization of this element kept by `asobj`, and the ones of elements
+        including it"""
+        d = self.__dict__
+        del d["_serialized"]
+        dependents = d.pop("_dependents", None)
+        for e in list(dependents.values()) if dependents else ():
+            if "_serialized" in e.__dict__:
+                e._invalidate()
 
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -51,17 +73,136 @@ class Element:
 
         cls.__repr__ = __repr__
         dataclasses.dataclass(cls)
+        cls._fields = [(f.name, cls._key(f.name)) for f in dataclasses.fields(cls)]
+        cls._serialize = _serializer(cls)
+
+
+def _set_flow_style(d: dict, *fields) -> dict:
+    for f in fields:
+        if f not in d:
+            continue
+        match d[f]:
+            case list():
+                d[f] = CommentedSeq(d[f])
+            case dict():
+                d[f] = CommentedMap(d[f])
+            case _:
+                continue
+        d[f].fa.set_flow_style()
+    return d
+
+
+def _serializer(cls: type[Element]) -> typing.Callable[[Element], dict]:
+    """Make the function serializing the fields of instances of `cls`, with fields and output keys
+    worked out once and for all rather than on each call"""
+    fields = cls._fields
+    flow_style = cls._flow_style
+
+    def _serialize(self):
+        ret = {}
+        for name, key in fields:
+            v = getattr(self, name)
+            if v is not None:
+                ret[key] = asobj(v)
+        if flow_style:
+            _set_flow_style(ret, *flow_style)
+        return ret
+
+    return _serialize
+
+
+# plain elements have no fields, like `On.status`
+Element._serialize = _serializer(Element)
+
+
+def _strip_markers(s: str) -> str:
+    return s.replace("\0", "")
+
+
+def _asdict(d: dict) -> dict:
+    return {instantiate(k): asobj(v) for k, v in d.items() if v is not None}
+
+
+def _aslist(l: list) -> list:
+    return [asobj(x) for x in l]
+
+
+def _identity(o: typing.Any) -> typing.Any:
+    return o
+
+
+# elements being serialized by `_serialized`, innermost last
+_serializing: list[Element] = []
+_missing = object()
+
+
+def _serialized(o: Element) -> typing.Any:
+    """Serialize `o`, reusing its serialization from previous calls if none of the fields of `o`
+    or of elements within it were reassigned since.
+
+    Serializations are shared, so they must not be changed. Changing lists or dictionaries of
+    elements in place is not tracked either: fields need to be reassigned once serialized.
+    """
+    d = o.__dict__
+    if _serializing:
+        # so that reassigning fields of `o` also invalidates the serialization including it
+        dependents = d.get("_dependents")
+        if dependents is None:
+            dependents = d["_dependents"] = weakref.WeakValueDictionary()
+        parent = _serializing[-1]
+        dependents[id(parent)] = parent
+    ret = d.get("_serialized", _missing)
+    if ret is not _missing:
+        metrics.count("asdict.reused")
+        return ret
+    _serializing.append(o)
+    try:
+        # `asdict` may be overridden
+        ret = type(o).asdict(o)
+    finally:
+        _serializing.pop()
+    d["_serialized"] = ret
+    return ret
+
+
+def serialization(o: Element) -> typing.Any:
+    """Get the serialization of `o` kept from a previous `asobj` call, if still valid, or `None`"""
+    return o.__dict__.get("_serialized")
+
+
+def _converter(ty: type) -> typing.Callable[[typing.Any], typing.Any]:
+    if ty is str:
+        return _strip_markers
+    if issubclass(ty, (Expr, str)):
+        return instantiate
+    if issubclass(ty, dict):
+        return _asdict
+    if issubclass(ty, list):
+        return _aslist
+    return _identity
+
+
+# value type -> function converting values of that type, filled in as types are encountered.
+# Builtin types, which most values have, are kept in a plain dictionary. Others are only weakly
+# referenced, as they may be defined by spec files, which are reloaded when watching or serving.
+# For the same reason, element types are not kept at all
+_builtin_converters: dict[type, typing.Callable[[typing.Any], typing.Any]] = {}
+_converters: weakref.WeakKeyDictionary[
+    type, typing.Callable[[typing.Any], typing.Any]
+] = weakref.WeakKeyDictionary()
 
 
 def asobj(o: typing.Any):
-    match o:
-        case Element() as e:
-            return e.asdict()
-        case Expr() | str():
-            return instantiate(o)
-        case dict() as d:
-            return {instantiate(k): asobj(v) for k, v in d.items() if v is not None}
-        case list() as l:
-            return [asobj(x) for x in l]
-        case _:
-            return o
+    ty = type(o)
+    convert = _builtin_converters.get(ty)
+    if convert is None:
+        if isinstance(o, Element):
+            return _serialized(o)
+        convert = _converters.get(ty)
+        if convert is None:
+            convert = _converter(ty)
+            if ty.__module__ == "builtins":
+                _builtin_converters[ty] = convert
+            else:
+                _converters[ty] = convert
+    return convert(o)
@@ -0,0 +1,452 @@
+"""YAML emitter backends.
+
+Workflows are dumped with a round-trip `ruamel.yaml` dumper, which is written in pure Python. When
+the C `libyaml` emitter shipped with `ruamel.yaml.clib` is available, the `libyaml` backend feeds it
+events instead. The two emitters do not make the same formatting choices for all scalars, so this
+backend only takes on documents where all scalars are ones for which they are known to agree,
+leaving the others to `ruamel.yaml`. Either way, output is the same whatever the backend.
+
+The `libyaml` backend also walks workflow elements directly, streaming their fields as events rather
+than serializing the whole workflow into dictionaries first. Only elements customizing `asdict` are
+serialized, one at a time.
+
+Repeated subtrees can be made to share the same object with `share_subtrees`, so that they are
+written once with an anchor and as aliases elsewhere when asked to. GitHub Actions accepts those,
+but not merge keys, which are not used. Otherwise repeated subtrees are written in full, as
+serializations of elements kept for reuse may appear in more than one place.
+
+Workflows can also be written as JSON, which is valid YAML, using the C accelerated encoder of the
+`json` module. That is much faster than any YAML backend, at the cost of readability.
+"""
+
+import collections
+import copy
+import functools
+import io
+import json
+import re
+import typing
+
+from . import metrics, timings
+
+if typing.TYPE_CHECKING:
+    from ruamel.yaml import YAML
+
+backends = ("auto", "ruamel", "libyaml")
+formats = ("yaml", "json")
+
+
+@functools.cache
+def ruamel_yaml(aliases: bool = False) -> "YAML":
+    """Get the `ruamel.yaml` dumper, writing collections appearing more than once with an anchor
+    and aliases if `aliases`, and in full each time otherwise"""
+    from ruamel.yaml import YAML
+    from ruamel.yaml.representer import RoundTripRepresenter
+
+    class Representer(RoundTripRepresenter):
+        def ignore_aliases(self, data: typing.Any) -> bool:
+            return True
+
+    ret = YAML()
+    ret.default_flow_style = False
+    if not aliases:
+        ret.Representer = Representer
+    return ret
+
+
+@functools.cache
+def libyaml_available() -> bool:
+    try:
+        from ruamel.yaml.cyaml import CEmitter
+    except ImportError:
+        return False
+    return True
+
+
+def dump(
+    data: typing.Any,
+    out: typing.TextIO,
+    backend: str = "auto",
+    header: str | None = None,
+    aliases: bool = False,
+):
+    """Dump `data` (serialized data or an element) as YAML into `out`, using `backend` if possible,
+    starting with `header` as a comment.
+
+    If `aliases`, collections appearing more than once in `data` are written once with an anchor,
+    and as aliases elsewhere. Otherwise they are written in full each time, as serializations of
+    elements may be shared."""
+    if backend != "ruamel" and libyaml_available():
+        try:
+            text = _LibyamlWriter(aliases).dump(data)
+        except _Unsupported:
+            metrics.count("emit.fallbacks")
+        else:
+            if header is not None:
+                out.write(f"# {header}\n")
+            out.write(text)
+            return
+    from ruamel.yaml import CommentedMap
+
+    if _is_element(data):
+        with timings.phase("asdict"):
+            data = data.asdict()
+    if header is not None:
+        # copy, so as not to change what was passed in
+        data = CommentedMap(data)
+        data.yaml_set_start_comment(header)
+    ruamel_yaml(aliases).dump(data, out)
+
+
+def share_subtrees(data: typing.Any, min_size: int) -> tuple[typing.Any, int]:
+    """Get a copy of `data` where repeated collections are replaced with the first one, so that
+    they are dumped as aliases, along with how many were replaced. `data` itself is left untouched.
+
+    Only collections whose compact JSON serialization is at least `min_size` characters long are
+    shared, outermost ones first. Collections with comments are never shared, as aliases would drop
+    them."""
+    # id -> (structural key, size) of collections, keys being `None` for unshareable ones
+    info: dict[int, tuple[typing.Hashable | None, int]] = {}
+    counts = collections.Counter()
+    # keep collections alive, so that their ids are not reused while replacing
+    visited = []
+
+    def analyze(o: typing.Any) -> tuple[typing.Hashable | None, int]:
+        match o:
+            case dict():
+                children = [(k, *analyze(v)) for k, v in o.items()]
+                size = 1 + sum(len(json.dumps(k)) + 2 + n for k, _, n in children)
+                key = (dict, _is_flow(o), tuple((k, c) for k, c, _ in children))
+                shareable = all(c is not None for _, c, _ in children)
+            case list():
+                children = [analyze(v) for v in o]
+                size = 1 + sum(n + 1 for _, n in children)
+                key = (list, _is_flow(o), tuple(c for c, _ in children))
+                shareable = all(c is not None for c, _ in children)
+            case _:
+                # `True == 1`: the type is part of the key, which also tells literal strings apart
+                return (type(o), o), len(json.dumps(o, ensure_ascii=False))
+        if not shareable or _has_comment(o):
+            key = None
+        visited.append(o)
+        info[id(o)] = key, size
+        counts[key] += 1
+        return key, size
+
+    firsts = {}
+    replaced = 0
+
+    def share(o: typing.Any) -> typing.Any:
+        nonlocal replaced
+        if not isinstance(o, (dict, list)):
+            return o
+        key, size = info[id(o)]
+        shared = key is not None and size >= min_size and counts[key] > 1
+        if shared and key in firsts:
+            replaced += 1
+            return firsts[key]
+        # a shallow copy keeps comments and flow style
+        ret = copy.copy(o)
+        for k, v in list(ret.items() if isinstance(ret, dict) else enumerate(ret)):
+            ret[k] = share(v)
+        if shared:
+            firsts[key] = ret
+        return ret
+
+    analyze(data)
+    ret = share(data)
+    return ret, replaced
+
+
+def _has_comment(o: typing.Any) -> bool:
+    ca = getattr(o, "ca", None)
+    return bool(ca and (ca.comment or ca.items or ca.end))
+
+
+def _is_flow(o: typing.Any) -> bool:
+    return bool(getattr(o, "fa", None) and o.fa.flow_style())
+
+
+def dump_json(data: typing.Any, out: typing.TextIO):
+    """Dump `data` as compact JSON into `out`"""
+    # `json` only uses its C encoder when not indenting
+    out.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+    out.write("\n")
+
+
+class _Unsupported(Exception):
+    """Raised when the `libyaml` emitter might not produce the same output as `ruamel.yaml`"""
+
+
+_str_tag = "tag:yaml.org,2002:str"
+_bool_tag = "tag:yaml.org,2002:bool"
+_int_tag = "tag:yaml.org,2002:int"
+# `ruamel.yaml` gives words longer than this a line of their own, `libyaml` does not
+_best_width = 80
+_comment_marker = re.compile(r"^( *)- __ghgen_comment_(\d+)__: x\n\1  ", re.M)
+
+# characters both emitters write as they are, excluding line breaks and special unicode ones
+_printable = r"\x20-\x7e\xa0-\ud7ff\ue000-\ufefe\uff00-\ufffd"
+_plain_block = re.compile(
+    rf"(?![-?:](?: |$)|---|\.\.\.|[ ,\[\]{{}}#&*!|>'\"%@`])[{_printable}]+(?<![ :])"
+)
+_plain_flow = re.compile(r"[a-zA-Z0-9_./$()+=~^@][a-zA-Z0-9_./$()+=~^@ -]*(?<! )")
+_quoted = re.compile(r"[!-&(-~]*")
+_literal = re.compile(rf"(?! )[{_printable}\n]+(?<![ \n])\n")
+
+
+@functools.cache
+def _analyzer():
+    from ruamel.yaml.emitter import Emitter
+
+    class Analyzer(Emitter):
+        # without a dumper, an emitter is its own serializer, of which only the version is used
+        use_version = None
+
+    return Analyzer(None, allow_unicode=True)
+
+
+@functools.cache
+def _resolve() -> typing.Callable[[str, tuple[bool, bool]], str]:
+    from ruamel.yaml.nodes import ScalarNode
+    from ruamel.yaml.resolver import VersionedResolver
+
+    return functools.partial(VersionedResolver().resolve, ScalarNode)
+
+
+@functools.lru_cache(maxsize=4096)
+def _ruamel_plain(value: str, flow: bool, key: bool) -> bool:
+    """Whether `ruamel.yaml` writes `value` as a plain scalar, following its `choose_scalar_style`"""
+    if _resolve()(value, (True, False)) != _str_tag:
+        # would be read back as something else than a string
+        return False
+    analysis = _analyzer().analyze_scalar(value)
+    if key and (analysis.empty or analysis.multiline):
+        return False
+    return analysis.allow_flow_plain if flow else analysis.allow_block_plain
+
+
+@functools.lru_cache(maxsize=4096)
+def _scalar_style(value: str, flow: bool, key: bool) -> str | None:
+    """Get the style `ruamel.yaml` writes a string with, raising `_Unsupported` if unsure `libyaml`
+    would write it the same way"""
+    if _ruamel_plain(value, flow, key):
+        if (
+            (_plain_flow if flow else _plain_block).fullmatch(value)
+            and " #" not in value
+            and ": " not in value
+            and not (key and len(value) > 100)
+            and not (
+                len(value) > _best_width
+                and max(map(len, value.split(" "))) > _best_width
+            )
+        ):
+            return None
+    elif _quoted.fullmatch(value):
+        return "'"
+    raise _Unsupported(value)
+
+
+def _anchor_names(data: typing.Any) -> dict[int, str]:
+    """Name collections appearing more than once in `data` by id, as `ruamel.yaml` does: in order of
+    their second appearance in a depth first walk not descending into already seen ones
+    """
+    seen = set()
+    ret = {}
+
+    def walk(o: typing.Any):
+        if not isinstance(o, (dict, list)):
+            return
+        if id(o) in seen:
+            if id(o) not in ret:
+                ret[id(o)] = f"id{len(ret) + 1:03d}"
+            return
+        seen.add(id(o))
+        for v in o.values() if isinstance(o, dict) else o:
+            walk(v)
+
+    walk(data)
+    return ret
+
+
+def _is_element(o: typing.Any) -> bool:
+    from .element import Element
+
+    return isinstance(o, Element)
+
+
+class _LibyamlWriter:
+    def __init__(self, aliases: bool = False):
+        from ruamel.yaml import events
+        from ruamel.yaml.comments import CommentedBase
+        from ruamel.yaml.cyaml import CEmitter
+        from ruamel.yaml.scalarstring import LiteralScalarString
+        from . import element
+
+        # imported once rather than for each node, as rendering runs with imports being tracked
+        self._events = events
+        self._commented_base = CommentedBase
+        self._literal_string = LiteralScalarString
+        self._elements = element
+        self._out = io.StringIO()
+        self._emitter = CEmitter(self._out, allow_unicode=True)
+        self._comments: list[str] = []
+        # id -> anchor of collections to write with one, and ids of the ones already written
+        self._anchors: dict[int, str] = {}
+        self._anchored: set[int] = set()
+        self._aliases = aliases
+
+    def dump(self, data: typing.Any) -> str:
+        events = self._events
+        emit = self._emitter.emit
+        emit(events.StreamStartEvent())
+        emit(events.DocumentStartEvent(explicit=False))
+        start = self._start_comment(data)
+        self._root = data
+        if self._aliases:
+            self._anchors = _anchor_names(data)
+        if isinstance(data, self._elements.Element):
+            self._element(data, flow=False)
+        else:
+            self._node(data, flow=False)
+        emit(events.DocumentEndEvent(explicit=False))
+        emit(events.StreamEndEvent())
+        text = _comment_marker.sub(self._comment, self._out.getvalue())
+        if "__ghgen_comment_" in text:
+            # a comment not placed before a block sequence item
+            raise _Unsupported(text)
+        return (start or "") + text
+
+    def _start_comment(self, data: typing.Any) -> str | None:
+        if not isinstance(data, self._commented_base):
+            return None
+        ca = data.ca
+        if ca.items or ca.end or ca.comment is None:
+            if ca.items or ca.end:
+                raise _Unsupported(ca)
+            return None
+        before, tokens = ca.comment[:2]
+        if before:
+            raise _Unsupported(ca)
+        return "".join(" " * t.column + t.value for t in tokens or ())
+
+    def _element(self, o: typing.Any, flow: bool):
+        """Stream the fields of element `o`, or write its serialization if it customizes it or if
+        one was kept from a previous one"""
+        elements = self._elements
+        serialized = elements.serialization(o)
+        if serialized is not None:
+            self._node(serialized, flow)
+            return
+        ty = type(o)
+        if ty.asdict is not elements.Element.asdict:
+            with timings.phase("asdict"):
+                o = o.asdict()
+            self._node(o, flow)
+            return
+        events = self._events
+        emit = self._emitter.emit
+        emit(events.MappingStartEvent(None, None, True, flow_style=flow))
+        for name, key in ty._fields:
+            v = getattr(o, name)
+            if v is not None:
+                self._node(key, flow, key=True)
+                self._model(
+                    v,
+                    flow or (key in ty._flow_style and isinstance(v, (list, dict))),
+                )
+        emit(events.MappingEndEvent())
+
+    def _model(self, o: typing.Any, flow: bool):
+        """Write `o` as part of an element, converting it as `asobj` would along the way"""
+        elements = self._elements
+        events = self._events
+        emit = self._emitter.emit
+        match o:
+            case elements.Element():
+                self._element(o, flow)
+            case dict():
+                emit(events.MappingStartEvent(None, None, True, flow_style=flow))
+                for k, v in o.items():
+                    if v is not None:
+                        self._node(elements.instantiate(k), flow, key=True)
+                        self._model(v, flow)
+                emit(events.MappingEndEvent())
+            case list():
+                emit(events.SequenceStartEvent(None, None, True, flow_style=flow))
+                for item in o:
+                    self._model(item, flow)
+                emit(events.SequenceEndEvent())
+            case _:
+                self._node(elements.asobj(o), flow)
+
+    def _anchor(self, o: typing.Any) -> str | None:
+        """Get the anchor to write collection `o` with, if any. If it was already written, write an
+        alias to it instead and return `...`"""
+        anchor = self._anchors.get(id(o))
+        if anchor is None:
+            return None
+        if id(o) in self._anchored:
+            self._emitter.emit(self._events.AliasEvent(anchor))
+            return ...
+        self._anchored.add(id(o))
+        return anchor
+
+    def _comment(self, m: re.Match) -> str:
+        return f"{self._comments[int(m[2])]}{m[1]}- "
+
+    def _node(self, o: typing.Any, flow: bool, key: bool = False):
+        events = self._events
+        emit = self._emitter.emit
+        match o:
+            case bool():
+                emit(
+                    events.ScalarEvent(
+                        None, _bool_tag, (True, False), "true" if o else "false"
+                    )
+                )
+            case int():
+                emit(events.ScalarEvent(None, _int_tag, (True, False), str(o)))
+            case self._literal_string():
+                if flow or key or not _literal.fullmatch(o) or " \n" in o:
+                    raise _Unsupported(o)
+                emit(
+                    events.ScalarEvent(None, _str_tag, (False, True), str(o), style="|")
+                )
+            case str() if type(o) is str:
+                style = _scalar_style(o, flow, key)
+                implicit = (style is None, True)
+                emit(events.ScalarEvent(None, _str_tag, implicit, o, style=style))
+            case dict():
+                anchor = self._anchor(o)
+                if anchor is ...:
+                    return
+                # the start comment of the root is written separately
+                comment = self._start_comment(o) if o is not self._root else None
+                flow = flow or _is_flow(o)
+                emit(events.MappingStartEvent(anchor, None, True, flow_style=flow))
+                if comment:
+                    if flow:
+                        raise _Unsupported(o)
+                    # replaced by the comment once emitted
+                    self._comments.append(comment)
+                    marker = f"__ghgen_comment_{len(self._comments) - 1}__"
+                    emit(events.ScalarEvent(None, None, (True, False), marker))
+                    emit(events.ScalarEvent(None, None, (True, False), "x"))
+                for k, v in o.items():
+                    self._node(k, flow, key=True)
+                    self._node(v, flow)
+                emit(events.MappingEndEvent())
+            case list():
+                anchor = self._anchor(o)
+                if anchor is ...:
+                    return
+                if o is not self._root and self._start_comment(o):
+                    raise _Unsupported(o)
+                flow = flow or _is_flow(o)
+                emit(events.SequenceStartEvent(anchor, None, True, flow_style=flow))
+                for item in o:
+                    self._node(item, flow)
+                emit(events.SequenceEndEvent())
+            case _:
+                raise _Unsupported(o)
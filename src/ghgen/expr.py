@@ -7,11 +7,16 @@ import weakref
 import contextlib
 
 from .types import RefTree
+from . import metrics
 
 
 class Expr(abc.ABC):
     _precedence: int = 0
 
+    def __new__(cls, *args: typing.Any, **kwargs: typing.Any):
+        metrics.count_by("expr.nodes", cls.__name__)
+        return super().__new__(cls)
+
     @property
     def _syntax(self) -> str: ...
 
@@ -159,16 +164,24 @@ class RefExpr(Expr):
         # for some reason local variables here pollute PyCharm's autocomplete, use `_` prefix to
         # avoid that
         _ref = cls._get(*args)
+        metrics.count(
+            "refexpr.intern.misses" if _ref is None else "refexpr.intern.hits"
+        )
         if _ref is not None:
             assert isinstance(
                 _ref, cls
             ), f"{type(_ref).__name__}({", ".join(map(repr, args))}) was created before this {cls.__name__}"
             return _ref
-        cls._store.pop(args, None)
         _instance = super().__new__(cls)
-        cls._store[args] = weakref.ref(_instance)
+        cls._store[args] = weakref.ref(_instance, functools.partial(cls._forget, args))
         return _instance
 
+    @classmethod
+    def _forget(cls, args: tuple[str, ...], ref: weakref.ReferenceType) -> None:
+        # drop the entry once the instance is gone, so that the store does not grow indefinitely
+        if cls._store.get(args) is ref:
+            del cls._store[args]
+
     def __init__(self, *args: str):
         super().__init__()
         object.__setattr__(self, "_segments", args)
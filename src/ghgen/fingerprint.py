@@ -0,0 +1,64 @@
+import hashlib
+import os
+import pathlib
+import typing
+
+from .cache import file_digest, ghgen_version, _sources_digest
+
+_fingerprint_prefix = "# fingerprint: "
+_dependencies_prefix = "# depends on: "
+
+
+def relative_dependencies(
+    input: pathlib.Path, dependencies: typing.Iterable[pathlib.Path | str]
+) -> list[str]:
+    return sorted(
+        pathlib.Path(os.path.relpath(d, input.resolve().parent)).as_posix()
+        for d in dependencies
+    )
+
+
+def compute(
+    input: pathlib.Path,
+    dependencies: typing.Iterable[str],
+    ids: typing.Iterable[str],
+    text: str,
+    output_options: str,
+) -> str:
+    """Compute the fingerprint of a workflow.
+
+    This hashes all that went into generating `text`: the contents of `input`, the contents of its
+    `dependencies` (given relative to `input`), the `ghgen` version and sources (as cache keys do),
+    the `output_options` (like the output format) and the ids of all workflows generated by `input`
+    (to detect removed outputs). `text` itself is hashed as well (to detect manual edits).
+    """
+    h = hashlib.sha256()
+    h.update(f"{ghgen_version()}\0{_sources_digest()}\0".encode())
+    h.update(f"{output_options}\0{file_digest(input)}\0".encode())
+    for d in dependencies:
+        h.update(f"{d}\0{file_digest(input.parent / d)}\0".encode())
+    h.update("\0".join(sorted(ids)).encode())
+    h.update(b"\0")
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def stamp(text: str, fingerprint: str, dependencies: list[str]) -> str:
+    """Add fingerprint and dependencies after the first (`generated from`) line of `text`"""
+    first, _, rest = text.partition("\n")
+    header = [first, f"{_fingerprint_prefix}{fingerprint}"]
+    if dependencies:
+        header.append(f"{_dependencies_prefix}{' '.join(dependencies)}")
+    return "\n".join(header) + "\n" + rest
+
+
+def parse(text: str) -> tuple[str | None, list[str], str]:
+    """Inverse of `stamp`, returning the fingerprint, the dependencies and the original text"""
+    lines = text.split("\n", 3)
+    fingerprint = None
+    dependencies = []
+    if len(lines) > 1 and lines[1].startswith(_fingerprint_prefix):
+        fingerprint = lines.pop(1).removeprefix(_fingerprint_prefix)
+        if len(lines) > 1 and lines[1].startswith(_dependencies_prefix):
+            dependencies = lines.pop(1).removeprefix(_dependencies_prefix).split()
+    return fingerprint, dependencies, "\n".join(lines)
@@ -0,0 +1,155 @@
+import collections
+import contextlib
+import functools
+import pathlib
+import typing
+
+from . import timings
+
+# frames kept per allocation, to find the ghgen or spec code responsible for it
+traceback_depth = 10
+
+# (group, location) -> (size, count) of memory allocated and still alive at some point. The same
+# allocation is accounted for both in the ghgen and the spec groups if both are involved
+type Sites = dict[tuple[str, str], tuple[int, int]]
+
+
+@contextlib.contextmanager
+def tracing() -> typing.Generator[None, None, None]:
+    """Trace memory allocations within the body, if not already doing so"""
+    import tracemalloc
+
+    if tracemalloc.is_tracing():
+        yield
+        return
+    tracemalloc.start(traceback_depth)
+    try:
+        yield
+    finally:
+        tracemalloc.stop()
+
+
+class Sampler:
+    """Collect the allocation sites of memory still alive when calling `sample`, compared to when
+    this object was created"""
+
+    def __init__(self, roots: typing.Iterable[pathlib.Path], keep: int = 50):
+        import tracemalloc
+
+        self._roots = [r.resolve() for r in roots]
+        self._keep = keep
+        self._groups = {}
+        self._start = tracemalloc.take_snapshot()
+
+    def _group(self, filename: str) -> str | None:
+        ret = self._groups.get(filename, ...)
+        if ret is ...:
+            from .ctx import _is_internal
+
+            if _is_internal(filename):
+                ret = "ghgen"
+            elif any(
+                pathlib.Path(filename).resolve().is_relative_to(r) for r in self._roots
+            ):
+                ret = "spec"
+            else:
+                ret = None
+            self._groups[filename] = ret
+        return ret
+
+    def _sites(self, traceback: typing.Sequence[typing.Any]) -> list[tuple[str, str]]:
+        """Get who is responsible for an allocation: the most recent frame in ghgen and the most
+        recent one in spec code, or the allocating frame if there are none of those"""
+        ret = {}
+        # frames are ordered from the oldest to the most recent one
+        for frame in reversed(traceback):
+            group = self._group(frame.filename)
+            if group is not None:
+                ret.setdefault(group, _location(frame.filename, frame.lineno))
+        if not ret:
+            frame = traceback[-1]
+            ret["other"] = _location(frame.filename, frame.lineno)
+        return list(ret.items())
+
+    def sample(self) -> Sites:
+        import tracemalloc
+
+        snapshot = tracemalloc.take_snapshot()
+        ret: Sites = {}
+        for diff in snapshot.compare_to(self._start, "traceback"):
+            if diff.size_diff <= 0:
+                continue
+            for site in self._sites(diff.traceback):
+                size, count = ret.get(site, (0, 0))
+                ret[site] = (size + diff.size_diff, count + max(diff.count_diff, 0))
+        # only keep the biggest sites of each group, to keep results small
+        kept = {}
+        counts = collections.Counter()
+        for site, value in sorted(ret.items(), key=lambda i: -i[1][0]):
+            if counts[site[0]] < self._keep:
+                counts[site[0]] += 1
+                kept[site] = value
+        return kept
+
+
+def merge(into: Sites, sites: Sites):
+    for site, (size, count) in sites.items():
+        total_size, total_count = into.get(site, (0, 0))
+        into[site] = (total_size + size, total_count + count)
+
+
+@functools.cache
+def _display_path(filename: str) -> pathlib.Path:
+    path = pathlib.Path(filename)
+    try:
+        return path.relative_to(pathlib.Path.cwd())
+    except ValueError:
+        return path
+
+
+def _location(filename: str, lineno: int) -> str:
+    return f"{_display_path(filename)}:{lineno}"
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+def report(peaks: timings.Peaks, sites: Sites, top: int) -> str:
+    """Format peak memory per phase and per subject, and the `top` allocation sites per group"""
+    by_phase: dict[str, int] = {}
+    by_subject: dict[str, int] = {}
+    for (subject, name), peak in peaks.items():
+        by_subject[subject] = max(by_subject.get(subject, 0), peak)
+        if name is not None:
+            by_phase[name] = max(by_phase.get(name, 0), peak)
+    rows = [["phase", "max peak"]]
+    rows += (
+        [name, format_size(peak)]
+        for name, peak in sorted(by_phase.items(), key=lambda i: (-i[1], i[0]))
+    )
+    ret = [timings.table(rows)]
+    subjects = sorted(by_subject.items(), key=lambda i: (-i[1], i[0]))[:top]
+    if subjects:
+        rows = [[f"largest {len(subjects)}", "peak"]]
+        rows += ([subject, format_size(peak)] for subject, peak in subjects)
+        ret.append(timings.table(rows))
+    groups: dict[str, list[tuple[str, int, int]]] = {}
+    for (group, location), (size, count) in sites.items():
+        groups.setdefault(group, []).append((location, size, count))
+    for group in ("ghgen", "spec", "other"):
+        entries = sorted(groups.get(group, ()), key=lambda e: (-e[1], e[0]))
+        if not entries:
+            continue
+        total = sum(size for _, size, _ in entries)
+        rows = [[f"{group} ({format_size(total)})", "size", "blocks"]]
+        rows += (
+            [location, format_size(size), str(count)]
+            for location, size, count in entries[:top]
+        )
+        ret.append(timings.table(rows))
+    return "\n\n".join(ret)
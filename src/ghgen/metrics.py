@@ -0,0 +1,109 @@
+import collections
+import contextlib
+import dataclasses
+import json
+import math
+import pathlib
+import typing
+
+
+@dataclasses.dataclass
+class Histogram:
+    count: int = 0
+    sum: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    # upper bound (power of 2) -> number of values
+    buckets: collections.Counter[float] = dataclasses.field(
+        default_factory=collections.Counter
+    )
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bound = 2.0 ** math.ceil(math.log2(value)) if value > 0 else 0.0
+        self.buckets[bound] += 1
+
+    def merge(self, other: "Histogram"):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.buckets.update(other.buckets)
+
+    def asdict(self) -> dict[str, typing.Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {f"{b:g}": n for b, n in sorted(self.buckets.items())},
+        }
+
+
+@dataclasses.dataclass
+class Registry:
+    counters: collections.Counter[str] = dataclasses.field(
+        default_factory=collections.Counter
+    )
+    # counters broken down by label, like the type of created expressions
+    labelled: dict[str, collections.Counter[str]] = dataclasses.field(
+        default_factory=dict
+    )
+    histograms: dict[str, Histogram] = dataclasses.field(default_factory=dict)
+
+    def merge(self, other: "Registry"):
+        self.counters.update(other.counters)
+        for name, counter in other.labelled.items():
+            self.labelled.setdefault(name, collections.Counter()).update(counter)
+        for name, histogram in other.histograms.items():
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+    def asdict(self) -> dict[str, typing.Any]:
+        counters = dict(self.counters)
+        counters |= {name: dict(c) for name, c in self.labelled.items()}
+        return {
+            "counters": dict(sorted(counters.items())),
+            "histograms": {
+                name: h.asdict() for name, h in sorted(self.histograms.items())
+            },
+        }
+
+    def save(self, file: pathlib.Path):
+        with open(file, "w") as out:
+            json.dump(self.asdict(), out, indent=2, sort_keys=True)
+            out.write("\n")
+
+
+# the registry being collected into, if any. Recording functions do nothing when this is `None`, so
+# that they can be left in hot paths
+_registry: Registry | None = None
+
+
+def count(name: str, n: int = 1):
+    if _registry is not None:
+        _registry.counters[name] += n
+
+
+def count_by(name: str, label: str, n: int = 1):
+    if _registry is not None:
+        _registry.labelled.setdefault(name, collections.Counter())[label] += n
+
+
+def observe(name: str, value: float):
+    if _registry is not None:
+        _registry.histograms.setdefault(name, Histogram()).observe(value)
+
+
+@contextlib.contextmanager
+def collecting() -> typing.Generator[Registry, None, None]:
+    """Collect metrics recorded within the body into the yielded registry"""
+    global _registry
+    previous = _registry
+    _registry = Registry()
+    try:
+        yield _registry
+    finally:
+        _registry = previous
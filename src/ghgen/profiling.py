@@ -0,0 +1,100 @@
+import contextlib
+import pathlib
+import typing
+
+from .timings import table
+
+aggregate_name = "all.pstats"
+
+
+class Profiles:
+    """Profiles of the workflows generated from an input file, each accumulated over all the
+    phases its generation goes through"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._profiles = {}
+
+    def workflow(self, id: str) -> typing.ContextManager[None]:
+        """Profile the body as part of the generation of workflow `id`"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._profile(id)
+
+    @contextlib.contextmanager
+    def _profile(self, id: str):
+        import cProfile
+
+        profile = self._profiles.setdefault(id, cProfile.Profile())
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+
+    def dump(self, dir: pathlib.Path) -> list[pathlib.Path]:
+        """Write a `.pstats` file per workflow into `dir`, returning them"""
+        ret = []
+        for id, profile in self._profiles.items():
+            file = dir / f"{id}.pstats"
+            profile.dump_stats(file)
+            ret.append(file)
+        return ret
+
+
+def _location(filename: str, lineno: int, name: str) -> str:
+    if filename == "~":
+        # builtin
+        return name
+    path = pathlib.Path(filename)
+    try:
+        path = path.relative_to(pathlib.Path.cwd())
+    except ValueError:
+        pass
+    return f"{path}:{lineno}({name})"
+
+
+def aggregate(
+    files: typing.Sequence[pathlib.Path],
+    dir: pathlib.Path,
+    roots: typing.Iterable[pathlib.Path],
+    top: int,
+) -> str:
+    """Merge the profiles in `files` into `dir`, returning a report of the `top` functions by
+    cumulative time, split between ghgen internals, user code found under `roots` and the rest
+    """
+    import pstats
+
+    from .ctx import _is_internal
+
+    stats = pstats.Stats(*map(str, files))
+    stats.dump_stats(dir / aggregate_name)
+    roots = [r.resolve() for r in roots]
+    groups = {"ghgen": [], "spec": [], "other": []}
+    for (filename, lineno, name), entry in stats.stats.items():
+        _, calls, tottime, cumtime, _ = entry
+        if filename != "~" and _is_internal(filename):
+            group = "ghgen"
+        elif filename != "~" and any(
+            pathlib.Path(filename).resolve().is_relative_to(r) for r in roots
+        ):
+            group = "spec"
+        else:
+            group = "other"
+        groups[group].append(
+            (cumtime, tottime, calls, _location(filename, lineno, name))
+        )
+    ret = []
+    for group, entries in groups.items():
+        if not entries:
+            continue
+        entries.sort(key=lambda e: (-e[0], e[3]))
+        rows = [
+            [f"{group} (top {min(top, len(entries))})", "cum ms", "self ms", "calls"]
+        ]
+        rows += (
+            [location, f"{cum * 1000:.1f}", f"{own * 1000:.1f}", str(calls)]
+            for cum, own, calls, location in entries[:top]
+        )
+        ret.append(table(rows))
+    return "\n\n".join(ret)
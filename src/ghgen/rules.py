@@ -2,6 +2,7 @@ import typing
 
 from .types import RefTree
 from .expr import RefExpr, reftree
+from . import timings, metrics
 
 
 def rule(e: RefExpr = RefExpr()):
@@ -64,6 +65,11 @@ class RuleSet(metaclass=_RuleSetMetaclass):
                 yield from RuleSet._traverse_reftree(rest, prefix + (k,))
 
     def validate(self, value: typing.Any, **kwargs: typing.Any) -> bool:
+        metrics.count("rules.validate")
+        with timings.phase("validate", rules=type(self).__name__):
+            return self._validate(value, **kwargs)
+
+    def _validate(self, value: typing.Any, **kwargs: typing.Any) -> bool:
         tree = reftree(value)
         if not tree:
             return True
@@ -71,6 +77,7 @@ class RuleSet(metaclass=_RuleSetMetaclass):
             for rule, func in self._rules.get(len(path), ()):
                 m = self._match(path, rule)
                 if m is not None:
+                    metrics.count_by("rules.fired", func.__name__)
                     if not func(self, *m, **kwargs):
                         return False
         return True
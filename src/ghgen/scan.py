@@ -0,0 +1,131 @@
+import ast
+import dataclasses
+import json
+import os
+import pathlib
+
+from .cache import ensure_dir
+
+
+@dataclasses.dataclass
+class Declaration:
+    # `None` if the id cannot be determined statically
+    id: str | None
+    lineno: int
+
+
+def _workflow_names(tree: ast.Module) -> set[str]:
+    ret = {"workflow"}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom):
+            ret.update(
+                a.asname for a in node.names if a.name == "workflow" and a.asname
+            )
+    return ret
+
+
+def _id_from_keywords(call: ast.Call, default: str | None) -> str | None:
+    for k in call.keywords:
+        if k.arg == "id":
+            match k.value:
+                case ast.Constant(value=str() as id):
+                    return id
+                case ast.Constant(value=None):
+                    return default
+                case _:
+                    return None
+    return default
+
+
+def scan_source(source: str, filename: str = "<unknown>") -> list[Declaration]:
+    """Find workflow declarations in python `source` without executing it.
+
+    This detects functions decorated with `@workflow` (or `@workflow(...)`) and direct calls to
+    `workflow(...)`."""
+    tree = ast.parse(source, filename)
+    names = _workflow_names(tree)
+
+    def is_workflow(node: ast.expr) -> bool:
+        match node:
+            case ast.Name(id=id):
+                return id in names
+            case ast.Attribute(attr="workflow"):
+                return True
+        return False
+
+    ret = []
+    decorators = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for d in node.decorator_list:
+                if is_workflow(d):
+                    ret.append(Declaration(node.name, node.lineno))
+                elif isinstance(d, ast.Call) and is_workflow(d.func):
+                    decorators.add(id(d))
+                    ret.append(
+                        Declaration(_id_from_keywords(d, node.name), node.lineno)
+                    )
+        elif (
+            isinstance(node, ast.Call)
+            and is_workflow(node.func)
+            and id(node) not in decorators
+            and (node.args or node.keywords)
+        ):
+            match node.args:
+                case [ast.Name(id=name), *_]:
+                    default = name
+                case _:
+                    default = None
+            ret.append(Declaration(_id_from_keywords(node, default), node.lineno))
+    ret.sort(key=lambda d: d.lineno)
+    return ret
+
+
+class Scanner:
+    """Scan input files for workflow declarations, caching results by file modification time and
+    size."""
+
+    def __init__(self, cache_file: pathlib.Path | None = None):
+        self.cache_file = cache_file
+        self._entries = {}
+        self._dirty = False
+        if cache_file:
+            try:
+                with open(cache_file) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def scan(self, file: pathlib.Path) -> list[Declaration] | None:
+        """Get declarations in `file`, or `None` if it cannot be parsed"""
+        try:
+            stat = file.stat()
+        except OSError:
+            return None
+        key = str(file.resolve())
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = self._entries.get(key)
+        if entry and entry["stamp"] == stamp:
+            decls = entry["declarations"]
+            return None if decls is None else [Declaration(**d) for d in decls]
+        try:
+            decls = scan_source(file.read_text(), str(file))
+        except (SyntaxError, ValueError, OSError):
+            # let execution report the actual problem
+            decls = None
+        self._entries[key] = {
+            "stamp": stamp,
+            "declarations": decls and [dataclasses.asdict(d) for d in decls],
+        }
+        self._dirty = True
+        return decls
+
+    def save(self):
+        if not self.cache_file or not self._dirty:
+            return
+        ensure_dir(self.cache_file.parent)
+        tmp = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self._entries, f)
+        tmp.replace(self.cache_file)
+        self._dirty = False
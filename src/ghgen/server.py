@@ -0,0 +1,106 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import pathlib
+import socketserver
+import sys
+import sysconfig
+import typing
+
+from . import deps
+from .ctx import _ctx
+
+# modules loaded from these directories are kept across requests
+_kept_dirs = [pathlib.Path(__file__).parent.resolve()] + [
+    pathlib.Path(sysconfig.get_path(p)).resolve()
+    for p in ("stdlib", "platstdlib", "purelib", "platlib")
+]
+
+
+class _Forward(logging.Handler):
+    def __init__(self, send: typing.Callable[..., None]):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord):
+        self.send(log=record.levelno, message=self.format(record))
+
+
+class _Stream(io.TextIOBase):
+    def __init__(self, send: typing.Callable[..., None], name: str):
+        self.send = send
+        self.name = name
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.send(**{self.name: text})
+        return len(text)
+
+
+@contextlib.contextmanager
+def _isolated(cwd: str, send: typing.Callable[..., None]):
+    """Run a request in `cwd`, forwarding logs and output and restoring global state afterwards.
+
+    Any module loaded while processing the request from outside the python installation is
+    unloaded, so that input files and their helpers are never shared between requests.
+    """
+    saved_cwd = os.getcwd()
+    saved_path = sys.path[:]
+    saved_modules = set(sys.modules)
+    root = logging.getLogger()
+    saved_handlers = root.handlers[:]
+    saved_level = root.level
+    root.handlers = [_Forward(send)]
+    _ctx.reset()
+    try:
+        os.chdir(cwd)
+        with (
+            contextlib.redirect_stdout(_Stream(send, "out")),
+            contextlib.redirect_stderr(_Stream(send, "err")),
+        ):
+            yield
+    finally:
+        for name in set(sys.modules) - saved_modules:
+            file = getattr(sys.modules[name], "__file__", None)
+            file = file and pathlib.Path(file).resolve()
+            if file and not any(file.is_relative_to(d) for d in _kept_dirs):
+                del sys.modules[name]
+        deps.reset()
+        _ctx.reset()
+        os.chdir(saved_cwd)
+        sys.path[:] = saved_path
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+
+
+def make_server(
+    path: pathlib.Path, run: typing.Callable[[list[str]], int]
+) -> socketserver.UnixStreamServer:
+    """Create a server on the unix socket `path`, processing requests with `run`.
+
+    Requests are processed one at a time."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, **message):
+            self.wfile.write(json.dumps(message).encode() + b"\n")
+            self.wfile.flush()
+
+        def handle(self):
+            request = json.loads(self.rfile.readline())
+            code = 1
+            with _isolated(request["cwd"], self.send):
+                try:
+                    code = run(request["argv"])
+                except SystemExit as e:
+                    code = e.code if isinstance(e.code, int) else int(bool(e.code))
+                except Exception:
+                    logging.exception("unexpected error")
+            self.send(exit=code)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.unlink(missing_ok=True)
+    return socketserver.UnixStreamServer(str(path), Handler)
@@ -0,0 +1,137 @@
+import dataclasses
+import hashlib
+import heapq
+import json
+import pathlib
+import typing
+
+
+@dataclasses.dataclass(frozen=True)
+class Shard:
+    # 1-based
+    index: int
+    total: int
+
+    def __str__(self):
+        return f"{self.index}/{self.total}"
+
+
+def parse(value: str) -> Shard:
+    """Parse a `INDEX/TOTAL` shard specification, as an `argparse` type"""
+    import argparse
+
+    try:
+        index, total = map(int, value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected INDEX/TOTAL, got {value!r}")
+    if total < 1 or not 1 <= index <= total:
+        raise argparse.ArgumentTypeError(
+            f"shard index must be between 1 and {total}, got {value!r}"
+        )
+    return Shard(index, total)
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8])
+
+
+def assign(
+    keys: typing.Iterable[str],
+    total: int,
+    weights: typing.Mapping[str, float] | None = None,
+) -> dict[str, int]:
+    """Assign each of `keys` to a 1-based shard out of `total`.
+
+    Without `weights`, each key goes to a shard determined by its hash alone, so that adding or
+    removing keys does not move the others around. With `weights`, keys are spread so that the
+    total weight of each shard is balanced, keys without a weight counting as the median of the
+    known ones. In both cases the result only depends on the arguments, so that independent
+    runners agree on the partition."""
+    keys = sorted(set(keys))
+    if not weights:
+        return {k: _hash(k) % total + 1 for k in keys}
+    import statistics
+
+    default = statistics.median(weights.values())
+    # greedily give the heaviest remaining key to the lightest shard
+    keys.sort(key=lambda k: (-weights.get(k, default), _hash(k), k))
+    loads = [(0.0, i) for i in range(1, total + 1)]
+    ret = {}
+    for k in keys:
+        load, i = heapq.heappop(loads)
+        ret[k] = i
+        heapq.heappush(loads, (load + weights.get(k, default), i))
+    return ret
+
+
+def load_timings(file: pathlib.Path) -> dict[str, float]:
+    with open(file) as f:
+        return json.load(f)
+
+
+@dataclasses.dataclass
+class Results:
+    """What a (possibly sharded) run did, as written by `--results`"""
+
+    shard: Shard | None = None
+    exit: int = 0
+    found: bool = False
+    inputs: list[str] = dataclasses.field(default_factory=list)
+    # generation time in seconds for each input
+    timings: dict[str, float] = dataclasses.field(default_factory=dict)
+    # logged errors, to be replayed when merging
+    errors: list[str] = dataclasses.field(default_factory=list)
+
+    def save(self, file: pathlib.Path):
+        data = dataclasses.asdict(self)
+        data["shard"] = self.shard and str(self.shard)
+        with open(file, "w") as out:
+            json.dump(data, out, indent=2)
+            out.write("\n")
+
+    @classmethod
+    def load(cls, file: pathlib.Path) -> "Results":
+        with open(file) as f:
+            data = json.load(f)
+        shard = data.pop("shard")
+        return cls(shard=shard and parse(shard), **data)
+
+
+def merge(results: typing.Sequence[Results]) -> Results:
+    """Combine per-shard results, checking that they cover all shards exactly once.
+
+    Problems with the shards themselves are reported as errors of the merged results."""
+    ret = Results()
+    totals = {r.shard.total for r in results if r.shard}
+    if any(r.shard is None for r in results) or len(totals) > 1:
+        ret.errors.append(
+            "cannot merge results of runs not sharded the same way: "
+            + ", ".join(str(r.shard or "unsharded") for r in results)
+        )
+    else:
+        (total,) = totals or {0}
+        indexes = sorted(r.shard.index for r in results)
+        if missing := sorted(set(range(1, total + 1)) - set(indexes)):
+            ret.errors.append(f"missing results for shard(s) {missing} out of {total}")
+        if duplicated := sorted({i for i in indexes if indexes.count(i) > 1}):
+            ret.errors.append(f"duplicate results for shard(s) {duplicated}")
+        elif overlap := sorted(
+            k
+            for k in {k for r in results for k in r.inputs}
+            if sum(k in r.inputs for r in results) > 1
+        ):
+            ret.errors.append(
+                f"inputs processed by several shards: {', '.join(overlap)}"
+            )
+    for r in sorted(results, key=lambda r: r.shard.index if r.shard else 0):
+        ret.found |= r.found
+        ret.inputs += r.inputs
+        ret.timings |= r.timings
+        ret.errors += r.errors
+        ret.exit = max(ret.exit, r.exit)
+    if ret.errors:
+        ret.exit = max(ret.exit, 1)
+    elif not ret.found:
+        ret.errors.append("no workflows found")
+        ret.exit = 2
+    return ret
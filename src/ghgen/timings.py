@@ -0,0 +1,265 @@
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import threading
+import time
+import typing
+
+# phases in pipeline order, used to order report columns
+phases = ("exec", "build", "validate", "asdict", "dump", "diff")
+
+
+@dataclasses.dataclass
+class PhaseTime:
+    wall: float = 0.0
+    cpu: float = 0.0
+    calls: int = 0
+
+    def add(self, other: "PhaseTime"):
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.calls += other.calls
+
+
+# (subject, phase) -> time spent in the phase, excluding nested phases
+type Times = dict[tuple[str, str], PhaseTime]
+type Peaks = dict[tuple[str, str | None], int]
+
+
+class Recording:
+    def __init__(self, timed: bool, traced: bool, memory: bool = False):
+        self.times: Times = {}
+        # Chrome Trace Event format events, if tracing
+        self.events: list[dict[str, typing.Any]] | None = [] if traced else None
+        # (subject, phase) -> peak traced memory above the one at the start of the phase, with
+        # `None` as phase for whole subjects. Requires `tracemalloc` to be tracing
+        self.peaks: Peaks = {}
+        self.timed = timed
+        self.memory = memory
+        self._stack: list[_Phase] = []
+
+
+_recording: Recording | None = None
+
+
+class _Phase:
+    __slots__ = (
+        "name",
+        "subject",
+        "timed",
+        "args",
+        "wall",
+        "cpu",
+        "nested_wall",
+        "nested_cpu",
+        "memory",
+        "peak",
+    )
+
+    def __init__(
+        self,
+        name: str | None,
+        subject: str | None,
+        timed: bool,
+        args: dict[str, typing.Any] | None = None,
+    ):
+        self.name = name
+        self.subject = subject
+        self.timed = timed
+        self.args = args
+
+    def __enter__(self):
+        stack = _recording._stack
+        if self.subject is None:
+            self.subject = stack[-1].subject if stack else ""
+        if _recording.memory:
+            self._enter_memory(stack)
+        stack.append(self)
+        self.nested_wall = self.nested_cpu = 0
+        self.cpu = time.process_time_ns()
+        self.wall = time.perf_counter_ns()
+
+    def __exit__(self, *args):
+        wall = time.perf_counter_ns() - self.wall
+        cpu = time.process_time_ns() - self.cpu
+        rec = _recording
+        stack = rec._stack
+        stack.pop()
+        if rec.memory:
+            self._exit_memory(stack, rec.peaks)
+        if rec.events is not None and self.name is not None:
+            rec.events.append(_event(self, wall))
+        if not (self.timed and rec.timed):
+            # time not spent in nested phases is accounted for by the enclosing phase
+            if stack:
+                stack[-1].nested_wall += self.nested_wall
+                stack[-1].nested_cpu += self.nested_cpu
+            return
+        if stack:
+            stack[-1].nested_wall += wall
+            stack[-1].nested_cpu += cpu
+        t = rec.times.setdefault((self.subject, self.name), PhaseTime())
+        t.add(
+            PhaseTime((wall - self.nested_wall) / 1e9, (cpu - self.nested_cpu) / 1e9, 1)
+        )
+
+    # peaks are tracked by resetting the `tracemalloc` peak at each phase boundary, propagating
+    # peaks reached so far to enclosing phases
+    def _enter_memory(self, stack: list["_Phase"]):
+        import tracemalloc
+
+        self.memory, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, peak)
+        tracemalloc.reset_peak()
+        self.peak = self.memory
+
+    def _exit_memory(self, stack: list["_Phase"], peaks: Peaks):
+        import tracemalloc
+
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        if self.timed or self.name is None:
+            key = (self.subject, self.name)
+            peaks[key] = max(peaks.get(key, 0), self.peak - self.memory)
+
+
+def _event(span: _Phase, duration: int) -> dict[str, typing.Any]:
+    ret = {
+        "name": span.name,
+        "cat": "ghgen",
+        "ph": "X",
+        # `perf_counter` is system-wide on the platforms we care about, so that events from
+        # worker processes line up
+        "ts": span.wall / 1000,
+        "dur": duration / 1000,
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+    }
+    if span.args:
+        ret["args"] = span.args
+    return ret
+
+
+_disabled = contextlib.nullcontext()
+
+
+def phase(
+    name: str, subject: str | None = None, **args: typing.Any
+) -> typing.ContextManager[None]:
+    """Time the body as phase `name` of `subject` (the one of the enclosing phase by default).
+
+    When tracing, this is also traced as a span tagged with `args`. This does nothing unless within
+    `recording()`, and is cheap enough to be left in hot paths."""
+    if _recording is None:
+        return _disabled
+    return _Phase(name, subject, True, args)
+
+
+def span(name: str, **args: typing.Any) -> typing.ContextManager[None]:
+    """Trace the body as a span tagged with `args`, without timing it as a phase of its own"""
+    if _recording is None or _recording.events is None:
+        return _disabled
+    return _Phase(name, None, False, args)
+
+
+def subject(subject: str) -> typing.ContextManager[None]:
+    """Set the subject of phases within the body, without timing anything"""
+    if _recording is None:
+        return _disabled
+    return _Phase(None, subject, False)
+
+
+@contextlib.contextmanager
+def recording(
+    timed: bool = True, traced: bool = False, memory: bool = False
+) -> typing.Generator[Recording, None, None]:
+    """Record phase times, trace events and/or memory peaks within the body"""
+    global _recording
+    previous = _recording
+    _recording = Recording(timed, traced, memory)
+    try:
+        yield _recording
+    finally:
+        _recording = previous
+
+
+def process_name(name: str) -> dict[str, typing.Any]:
+    """Get a trace metadata event naming the current process"""
+    return {
+        "name": "process_name",
+        "ph": "M",
+        "pid": os.getpid(),
+        "args": {"name": name},
+    }
+
+
+def save_trace(events: list[dict[str, typing.Any]], file: pathlib.Path):
+    with open(file, "w") as out:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out)
+
+
+def merge(into: Times, times: Times):
+    for key, t in times.items():
+        into.setdefault(key, PhaseTime()).add(t)
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}"
+
+
+def table(rows: list[list[str]]) -> str:
+    """Format `rows` as aligned columns, the first one left-aligned and the others right-aligned"""
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    return "\n".join(
+        "  ".join(
+            c.ljust(w) if i == 0 else c.rjust(w)
+            for i, (c, w) in enumerate(zip(r, widths))
+        ).rstrip()
+        for r in rows
+    )
+
+
+def report(times: Times, top: int) -> str:
+    """Format an aggregate table of `times` per phase, and a per-subject one for the `top`
+    slowest subjects, both sorted by decreasing wall time"""
+    by_phase: dict[str, PhaseTime] = {}
+    by_subject: dict[str, dict[str, PhaseTime]] = {}
+    for (subject, name), t in times.items():
+        by_phase.setdefault(name, PhaseTime()).add(t)
+        by_subject.setdefault(subject, {})[name] = t
+    total = PhaseTime()
+    for t in by_phase.values():
+        total.add(t)
+    rows = [["phase", "wall ms", "cpu ms", "%", "calls"]]
+    for name, t in sorted(by_phase.items(), key=lambda i: -i[1].wall):
+        share = f"{100 * t.wall / total.wall:.1f}" if total.wall else "-"
+        rows.append([name, _ms(t.wall), _ms(t.cpu), share, str(t.calls)])
+    rows.append(["total", _ms(total.wall), _ms(total.cpu), "", ""])
+    ret = [table(rows)]
+    columns = [p for p in phases if p in by_phase]
+    columns += sorted(by_phase.keys() - set(columns))
+    subjects = sorted(
+        by_subject.items(),
+        key=lambda i: (-sum(t.wall for t in i[1].values()), i[0]),
+    )[:top]
+    if subjects:
+        rows = [
+            [f"slowest {len(subjects)}", "wall ms", "cpu ms"]
+            + [f"{p} ms" for p in columns]
+        ]
+        for subject, ts in subjects:
+            rows.append(
+                [
+                    subject,
+                    _ms(sum(t.wall for t in ts.values())),
+                    _ms(sum(t.cpu for t in ts.values())),
+                ]
+                + [_ms(ts[p].wall) if p in ts else "-" for p in columns]
+            )
+        ret.append(table(rows))
+    return "\n\n".join(ret)
@@ -0,0 +1,157 @@
+import ctypes
+import ctypes.util
+import os
+import pathlib
+import select
+import struct
+import sys
+import time
+import typing
+
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_event = struct.Struct("iIII")
+
+
+def _watched_dirs(dirs: typing.Iterable[pathlib.Path]) -> list[pathlib.Path]:
+    ret = []
+    for d in dirs:
+        for root, subdirs, _ in os.walk(d):
+            ret.append(pathlib.Path(root))
+            subdirs[:] = [
+                s for s in subdirs if not s.startswith(".") and s != "__pycache__"
+            ]
+    return ret
+
+
+class Watcher(typing.Protocol):
+    def wait(self, timeout: float | None = None) -> set[pathlib.Path]:
+        """Wait for changes to python files, returning the changed ones.
+
+        An empty set is returned if nothing changed within `timeout` seconds."""
+        ...
+
+    def close(self): ...
+
+
+class Inotify:
+    # how long to wait for more events after a first one, as editors tend to save in several steps
+    debounce = 0.05
+
+    def __init__(self, dirs: typing.Iterable[pathlib.Path]):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        mask = (
+            _IN_MODIFY
+            | _IN_CLOSE_WRITE
+            | _IN_MOVED_FROM
+            | _IN_MOVED_TO
+            | _IN_CREATE
+            | _IN_DELETE
+        )
+        for d in _watched_dirs(dirs):
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(d), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), f"cannot watch {d}")
+            self._dirs[wd] = d
+
+    def _read(self, timeout: float | None) -> set[pathlib.Path] | None:
+        """Read pending events, returning changed python files, or `None` on timeout"""
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return None
+        ret = set()
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = _event.unpack_from(data, offset)
+            offset += _event.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self._dirs and name.endswith(b".py"):
+                ret.add(self._dirs[wd] / os.fsdecode(name))
+        return ret
+
+    def wait(self, timeout: float | None = None) -> set[pathlib.Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ret = set()
+        while not ret:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining < 0:
+                break
+            changed = self._read(remaining)
+            if changed is None:
+                break
+            ret |= changed
+        if ret:
+            while (changed := self._read(self.debounce)) is not None:
+                ret |= changed
+        return ret
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class Poller:
+    interval = 0.5
+
+    def __init__(self, dirs: typing.Iterable[pathlib.Path]):
+        self._dirs = list(dirs)
+        self._state = self._scan()
+
+    def _scan(self) -> dict[pathlib.Path, tuple[int, int]]:
+        ret = {}
+        for d in _watched_dirs(self._dirs):
+            for f in d.glob("*.py"):
+                try:
+                    stat = f.stat()
+                except OSError:
+                    continue
+                ret[f] = (stat.st_mtime_ns, stat.st_size)
+        return ret
+
+    def wait(self, timeout: float | None = None) -> set[pathlib.Path]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self._scan()
+            ret = {
+                f
+                for f in state.keys() | self._state.keys()
+                if state.get(f) != self._state.get(f)
+            }
+            self._state = state
+            if ret:
+                return ret
+            if deadline is not None and time.monotonic() >= deadline:
+                return ret
+            time.sleep(
+                self.interval
+                if deadline is None
+                else max(0, min(self.interval, deadline - time.monotonic()))
+            )
+
+    def close(self):
+        pass
+
+
+def watcher(dirs: typing.Iterable[pathlib.Path], poll: bool = False) -> Watcher:
+    """Get an inotify based watcher if available, falling back to polling otherwise"""
+    dirs = list(dirs)
+    if not poll and sys.platform == "linux":
+        try:
+            return Inotify(dirs)
+        except (OSError, AttributeError):
+            pass
+    return Poller(dirs)
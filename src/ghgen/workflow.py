@@ -3,7 +3,7 @@ import typing
 
 from ruamel.yaml import CommentedSeq
 
-from .element import Element
+from .element import Element, _set_flow_style
 from typing import Any, cast
 from .expr import Value, Expr, ProxyExpr, RefExpr, instantiate, ErrorExpr
 from dataclasses import field
@@ -11,21 +11,6 @@ from ruamel.yaml.scalarstring import LiteralScalarString
 from ruamel.yaml.comments import CommentedMap, CommentedSeq
 
 
-def _set_flow_style(d: dict, *fields) -> dict:
-    for f in fields:
-        if f not in d:
-            continue
-        match d[f]:
-            case list():
-                d[f] = CommentedSeq(d[f])
-            case dict():
-                d[f] = CommentedMap(d[f])
-            case _:
-                continue
-        d[f].fa.set_flow_style()
-    return d
-
-
 class Input[T](Element):
     Type: typing.ClassVar[type] = typing.Literal[
         "boolean", "choice", "number", "environment", "string"
@@ -176,8 +161,12 @@ def _dictionarize(d: dict, *args: str) -> dict:
         if k not in d:
             continue
         serialized: list = d.pop(k)
-        print(serialized)
-        d[k] = {id: x for id, x in ((e.pop("id", None), e) for e in serialized) if id}
+        # serializations of elements are shared, build new ones without ids
+        d[k] = {
+            e["id"]: {x: v for x, v in e.items() if x != "id"}
+            for e in serialized
+            if e.get("id")
+        }
     return d
 
 
@@ -379,8 +368,7 @@ class Job(Element):
     uses: str
     with_: dict[str, Value]
 
-    def asdict(self) -> typing.Any:
-        return _set_flow_style(super().asdict(), "needs")
+    _flow_style = ("needs",)
 
 
 class Workflow(Element):
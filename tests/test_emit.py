@@ -0,0 +1,337 @@
+import io
+import random
+import typing
+
+import pytest
+from ruamel.yaml.comments import CommentedMap, CommentedSeq
+from ruamel.yaml.scalarstring import LiteralScalarString
+
+from src.ghgen import emit, metrics
+
+pytestmark = pytest.mark.skipif(
+    not emit.libyaml_available(), reason="`ruamel.yaml.clib` not installed"
+)
+
+# pieces random strings are made of, favouring the ones YAML gives a special meaning to
+_alphabet = list("ab :#-?'\"\n{}[],&*!|>%@`\\.~=$()+^/_é😀") + [
+    "  ",
+    "yes",
+    "true",
+    "null",
+    "~",
+    "1",
+    "0x1",
+    "1e3",
+    ".5",
+    "${{ x }}",
+    "- ",
+    ": ",
+    " #",
+    "\n\n",
+    "---",
+    "...",
+    "x" * 90,
+    "abc " * 10,
+]
+
+
+def _documents(s: str, flow: bool = True) -> list[CommentedMap]:
+    """Get workflow-like documents with `s` in each of the places where generated workflows can
+    have strings, including flow style collections if `flow`"""
+
+    def document(**jobs) -> CommentedMap:
+        ret = CommentedMap({"name": "x", "jobs": {"j": jobs}})
+        ret.yaml_set_start_comment("generated from x.py::x")
+        return ret
+
+    def step(**values) -> CommentedMap:
+        ret = CommentedMap(values)
+        ret.yaml_set_start_comment("needs a, b", indent=4)
+        return ret
+
+    def flow_seq(*values) -> CommentedSeq:
+        ret = CommentedSeq(values)
+        ret.fa.set_flow_style()
+        return ret
+
+    ret = [
+        document(name=s),
+        document(env={s: "x"}),
+        document(steps=[{"run": s}]),
+        document(steps=[step(run=s)]),
+        document(steps=[{"with": {"x": [s]}}]),
+    ]
+    if flow:
+        ret.append(document(needs=flow_seq(s, "a")))
+        ret.append(document(strategy={"matrix": {"x": flow_seq("a", s)}}))
+    if s.strip():
+        ret.append(
+            document(steps=[{"run": LiteralScalarString(s.rstrip("\n") + "\n")}])
+        )
+    return ret
+
+
+def _check(s: str, flow: bool = True) -> bool:
+    """Check `libyaml` output for `s` is the same as `ruamel.yaml` one, returning whether it was
+    written with `libyaml` in all places"""
+    ret = True
+    for doc in _documents(s, flow):
+        expected = io.StringIO()
+        emit.dump(doc, expected, "ruamel")
+        try:
+            actual = emit._LibyamlWriter().dump(doc)
+        except emit._Unsupported:
+            ret = False
+            continue
+        assert actual == expected.getvalue(), f"different output for {s!r}"
+    return ret
+
+
+def test_random_strings():
+    rng = random.Random(0)
+    for _ in range(300):
+        _check("".join(rng.choice(_alphabet) for _ in range(rng.randint(0, 6))))
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        "",
+        "echo Hello, world",
+        "ubuntu-latest",
+        "${{ github.event_name == 'push' }}",
+        "${{ matrix.os }}",
+        "actions/checkout@v4",
+        "refs/heads/main",
+        "!steps.x.outputs",
+        "*.py",
+        "1.2",
+        "on",
+        "x" * 200,
+        " ".join(["x" * 40] * 5),
+        "a: b",
+        "a #b",
+        "a'b",
+        '"quoted"',
+        "?|",
+        "- x",
+        "café ☕",
+        "😀",
+        "line\nbreak",
+        "echo a\necho b\n",
+        "trailing \n",
+        "tab\tseparated",
+        " leading",
+    ],
+)
+def test_strings(s):
+    _check(s)
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        "echo Hello, world",
+        "${{ github.event_name == 'push' }}",
+        "actions/checkout@v4",
+        "!steps.x.outputs",
+        "café ☕",
+    ],
+)
+def test_common_strings_do_not_fall_back(s):
+    assert _check(s, flow=False)
+
+
+@pytest.mark.parametrize("s", ["build", "ubuntu-latest", "3.12", "${{matrix.os}}"])
+def test_common_flow_strings_do_not_fall_back(s):
+    assert _check(s)
+
+
+def test_fallback_is_counted():
+    with metrics.collecting() as registry:
+        out = io.StringIO()
+        emit.dump({"run": "tab\tseparated"}, out, "libyaml")
+        emit.dump({"run": "echo"}, out, "libyaml")
+    assert out.getvalue() == 'run: "tab\\tseparated"\nrun: echo\n'
+    assert registry.counters["emit.fallbacks"] == 1
+
+
+def test_large_document_does_not_fall_back():
+    doc = CommentedMap(
+        {
+            f"j{j}": {
+                "runs-on": "ubuntu-latest",
+                "steps": [
+                    {
+                        "name": f"step {i}",
+                        "run": LiteralScalarString("echo a\necho b\n"),
+                    }
+                    for i in range(100)
+                ],
+            }
+            for j in range(10)
+        }
+    )
+    with metrics.collecting() as registry:
+        libyaml = _dump(doc, "libyaml")
+    assert libyaml == _dump(doc, "ruamel")
+    assert not registry.counters["emit.fallbacks"]
+
+
+def _workflow(steps: int):
+    from src.ghgen.workflow import (
+        Container,
+        Job,
+        Matrix,
+        On,
+        Step,
+        Strategy,
+        Workflow,
+        WorkflowDispatch,
+        Input,
+    )
+
+    ret = Workflow(
+        name="streamed",
+        on=On(workflow_dispatch=WorkflowDispatch(inputs=[Input("an input", id="x")])),
+        env={"A": "a"},
+    )
+    for j in range(10):
+        ret.jobs[f"j{j}"] = Job(
+            needs=[f"j{j - 1}"] if j else None,
+            runs_on="ubuntu-latest",
+            container=Container("python:3.12", env={"B": "b"}),
+            strategy=Strategy(matrix=Matrix(os=["linux", "windows"]), fail_fast=False),
+            steps=[
+                Step(
+                    name=f"step {i}",
+                    run=f"echo {i}\necho done",
+                    needs=["x"] if i % 10 == 0 else None,
+                )
+                for i in range(steps // 10)
+            ],
+        )
+    return ret
+
+
+def test_elements_are_streamed():
+    import tracemalloc
+
+    expected = io.StringIO()
+    emit.dump(_workflow(2000), expected, "ruamel", "header")
+    assert "# needs x\n" in expected.getvalue()
+    peaks = {}
+    # fresh workflows, as serializing keeps the serializations of elements
+    for name, w in (("streamed", _workflow(2000)), ("serialized", _workflow(2000))):
+        out = io.StringIO()
+        tracemalloc.start()
+        try:
+            with metrics.collecting() as registry:
+                emit.dump(
+                    w if name == "streamed" else w.asdict(), out, "libyaml", "header"
+                )
+            peaks[name] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert not registry.counters["emit.fallbacks"]
+        assert out.getvalue() == expected.getvalue()
+    assert peaks["streamed"] * 2 < peaks["serialized"]
+
+
+def test_imports_do_not_grow_with_nodes(monkeypatch):
+    import builtins
+
+    original_import = builtins.__import__
+    imports = []
+
+    def counting_import(name, globals=None, *args, **kwargs):
+        if globals and globals.get("__package__") == emit.__package__:
+            imports.append(name)
+        return original_import(name, globals, *args, **kwargs)
+
+    # first dumps import what is needed once
+    emit.dump(_workflow(10), io.StringIO(), "libyaml")
+    counts = {}
+    for steps in (10, 1000):
+        w = _workflow(steps)
+        monkeypatch.setattr(builtins, "__import__", counting_import)
+        with metrics.collecting() as registry:
+            emit.dump(w, io.StringIO(), "libyaml")
+        monkeypatch.undo()
+        assert not registry.counters["emit.fallbacks"]
+        counts[steps] = len(imports)
+        imports.clear()
+    # imports while rendering go through the hook tracking dependencies, which is slow
+    assert counts[1000] == counts[10]
+
+
+def _shareable(rng: random.Random, depth: int = 0) -> typing.Any:
+    # small pools of values, so that equal subtrees come up often
+    match rng.randrange(6 if depth < 4 else 2):
+        case 0:
+            return rng.choice(["a", "b c", "${{ x }}", "1"])
+        case 1:
+            return rng.choice([True, 3, LiteralScalarString("echo\n")])
+        case 2 | 3:
+            ret = CommentedMap(
+                (k, _shareable(rng, depth + 1)) for k in rng.sample("abc", 2)
+            )
+        case 4:
+            ret = CommentedSeq(_shareable(rng, depth + 1) for _ in range(2))
+        case _:
+            ret = CommentedSeq(rng.choice("ab") for _ in range(2))
+            ret.fa.set_flow_style()
+    return ret
+
+
+def test_shared_subtrees_dump_the_same():
+    from ruamel.yaml import YAML
+
+    rng = random.Random(0)
+    for _ in range(200):
+        data = CommentedMap((k, _shareable(rng)) for k in "abcdef")
+        expected = YAML(typ="safe").load(io.StringIO(_dump(data, "ruamel")))
+        shared, _ = emit.share_subtrees(data, 0)
+        text = _dump(shared, "ruamel", aliases=True)
+        assert _dump(shared, "libyaml", aliases=True) == text
+        assert YAML(typ="safe").load(io.StringIO(text)) == expected
+        # without aliases, output is unchanged
+        assert _dump(shared, "libyaml") == _dump(data, "ruamel")
+
+
+def _dump(data: typing.Any, backend: str, aliases: bool = False) -> str:
+    ret = io.StringIO()
+    emit.dump(data, ret, backend, aliases=aliases)
+    return ret.getvalue()
+
+
+def test_share_subtrees():
+    env = {"A": "a", "B": "b"}
+    small = {"C": "c"}
+
+    def step():
+        ret = CommentedMap({"run": "make", "env": dict(env)})
+        ret.yaml_set_start_comment("needs a", indent=4)
+        return ret
+
+    data = {
+        "env": dict(env),
+        "jobs": {
+            "a": {"env": dict(env), "with": dict(small), "steps": [step()]},
+            "b": {"env": dict(env), "with": dict(small), "steps": [step()]},
+        },
+    }
+    shared, replaced = emit.share_subtrees(data, 15)
+    assert replaced == 4
+    a, b = shared["jobs"]["a"], shared["jobs"]["b"]
+    assert a["env"] is shared["env"] and b["env"] is shared["env"]
+    # too small
+    assert a["with"] is not b["with"]
+    # commented blocks are not shared, but blocks within them are
+    assert a["steps"] is not b["steps"]
+    assert a["steps"][0]["env"] is shared["env"]
+    assert _dump(shared, "libyaml", aliases=True).startswith(
+        "env: &id001\n  A: a\n  B: b\njobs:\n"
+    )
+    # the original is left untouched
+    assert data["jobs"]["a"]["env"] is not data["env"]
@@ -27,6 +27,14 @@ def test_ops():
     )
 
 
+def test_ref_store_does_not_leak():
+    a = RefExpr("a", "b")
+    assert RefExpr("a", "b") is a
+    assert ("a", "b") in RefExpr._store
+    del a
+    assert ("a", "b") not in RefExpr._store
+
+
 def test_reftree():
     a = RefExpr("a")
     b = RefExpr("b")
@@ -0,0 +1,1252 @@
+import argparse
+import dataclasses
+import inspect
+import io
+import json
+import logging
+import os
+import subprocess
+import time
+import pathlib
+import shutil
+import sys
+import textwrap
+import timeit
+import typing
+
+import pytest
+
+from src.ghgen import main, options, _regenerate
+from src.ghgen import client, shard
+from src.ghgen.scan import scan_source, Declaration
+from src.ghgen.watch import Inotify, Poller
+
+
+@pytest.fixture
+def specs(tmp_path, monkeypatch):
+    input = tmp_path / "input"
+    input.mkdir()
+    output = tmp_path / "output"
+    output.mkdir()
+    lib = tmp_path / "lib"
+    lib.mkdir()
+    monkeypatch.setattr(sys, "path", sys.path[:])
+    modules = set(sys.modules)
+
+    class Specs:
+        dir = input
+        out = output
+
+        def write(self, name: str, code: str, dir: pathlib.Path = input):
+            (dir / name).write_text(textwrap.dedent(code))
+
+        def write_lib(self, name: str, code: str):
+            self.write(name, code, dir=lib)
+
+        def args(self, *args: str, command: str = "generate") -> list[str]:
+            return [command, "-I", str(lib), "-D", str(output), *args, str(input)]
+
+        def run(self, *args: str, command: str = "generate") -> int:
+            return main(self.args(*args, command=command))
+
+    yield Specs()
+    # only unload test files, as standard modules may be lazily imported by ghgen meanwhile
+    for m in set(sys.modules) - modules:
+        file = getattr(sys.modules[m], "__file__", None)
+        if file and pathlib.Path(file).is_relative_to(tmp_path):
+            del sys.modules[m]
+
+
+def _workflow_spec(*ids: str) -> str:
+    return "from ghgen.ctx import *\n" + "".join(
+        f"""
+
+@workflow
+def {id}():
+    on.workflow_dispatch()
+    run("echo {id}")
+"""
+        for id in ids
+    )
+
+
+def _messages(caplog) -> list[tuple[int, str]]:
+    return [(r.levelno, r.getMessage()) for r in caplog.records]
+
+
+def test_generate(specs, caplog):
+    specs.write("a.py", _workflow_spec("one", "two"))
+    assert specs.run() == 0
+    assert sorted(p.name for p in specs.out.iterdir()) == ["one.yml", "two.yml"]
+    assert specs.run("--check") == 0
+
+
+def test_no_workflows(specs, caplog):
+    specs.write("a.py", "x = 42\n")
+    assert specs.run() == 2
+    assert (logging.ERROR, "no workflows found") in _messages(caplog)
+
+
+def test_check_mismatch(specs, caplog):
+    specs.write("a.py", _workflow_spec("one"))
+    assert specs.run() == 0
+    (specs.out / "one.yml").write_text("something else\n")
+    caplog.clear()
+    assert specs.run("--check") == 1
+    assert any(level == logging.ERROR for level, _ in _messages(caplog))
+
+
+@pytest.mark.parametrize("mode", [(), ("--strict",)])
+def test_own_workflows_are_up_to_date(mode):
+    root = pathlib.Path(__file__).parents[1]
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, ghgen; sys.exit(ghgen.main(sys.argv[1:]))",
+            "--check",
+            "--no-cache",
+            *mode,
+        ],
+        cwd=root,
+        env=os.environ | {"PYTHONPATH": str(root / "src")},
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_parallel_is_deterministic(specs, caplog):
+    for i in range(6):
+        specs.write(f"spec{i}.py", _workflow_spec(f"wf{i}a", f"wf{i}b"))
+    specs.write("broken.py", _workflow_spec("broken").replace('"echo', 'f"{matrix.x}'))
+    assert specs.run("--jobs", "1", "--check") == 1
+    sequential = _messages(caplog)
+    caplog.clear()
+    assert specs.run("--jobs", "4", "--check") == 1
+    assert _messages(caplog) == sequential
+
+
+def _counting_spec(*ids: str) -> str:
+    return (
+        "import pathlib\n"
+        "with open(pathlib.Path(__file__).with_suffix('.runs'), 'a') as runs:\n"
+        "    runs.write('.')\n" + _workflow_spec(*ids)
+    )
+
+
+def _runs(specs, name: str) -> int:
+    return len((specs.dir / name).with_suffix(".runs").read_text())
+
+
+def test_cache(specs):
+    specs.write("a.py", _counting_spec("one"))
+    specs.write("b.py", _counting_spec("two"))
+    assert specs.run() == 0
+    assert specs.run() == 0
+    assert specs.run("--check") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (1, 1)
+    specs.write("b.py", _counting_spec("two", "three"))
+    assert specs.run() == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (1, 2)
+    assert (specs.out / "three.yml").exists()
+    assert specs.run("--no-cache") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 3)
+
+
+def test_cache_hit_still_checks_output(specs, caplog):
+    specs.write("a.py", _counting_spec("one"))
+    assert specs.run() == 0
+    (specs.out / "one.yml").write_text("something else\n")
+    assert specs.run("--check") == 1
+    assert _runs(specs, "a.py") == 1
+    assert specs.run() == 0
+    assert specs.run("--check") == 0
+    assert _runs(specs, "a.py") == 1
+
+
+def test_errors_are_not_cached(specs, caplog):
+    specs.write("a.py", _counting_spec("one").replace('"echo', 'f"{matrix.x}'))
+    assert specs.run() == 1
+    assert specs.run() == 1
+    assert _runs(specs, "a.py") == 2
+
+
+def _cache_stats(capsys) -> dict[str, str]:
+    capsys.readouterr()
+    assert main(["cache", "stats"]) == 0
+    lines = capsys.readouterr().out.splitlines()
+    return dict(map(str.strip, l.split("  ", 1)) for l in lines)
+
+
+def test_shared_cache(specs, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("GHGEN_SHARED_CACHE", str(tmp_path / "shared"))
+    specs.write_lib("helper.py", "")
+    specs.write("a.py", "import helper\n" + _counting_spec("one"))
+    for local in ("local1", "local2"):
+        assert specs.run("--cache-directory", str(tmp_path / local)) == 0
+    assert _runs(specs, "a.py") == 1
+    specs.write_lib("helper.py", "x = 1\n")
+    assert specs.run("--cache-directory", str(tmp_path / "local3")) == 0
+    assert _runs(specs, "a.py") == 2
+    # another checkout somewhere else
+    clone = tmp_path / "clone"
+    for dir in ("input", "lib"):
+        shutil.copytree(tmp_path / dir, clone / dir)
+    (clone / "input" / "a.runs").unlink()
+    (clone / "output").mkdir()
+    args = ["-I", str(clone / "lib"), "-D", str(clone / "output"), str(clone / "input")]
+    assert main(["generate", "--cache-directory", str(clone / "cache"), *args]) == 0
+    assert not (clone / "input" / "a.runs").exists()
+    output = (clone / "output" / "one.yml").read_text()
+    assert output == (specs.out / "one.yml").read_text()
+    stats = _cache_stats(capsys)
+    assert (stats["manifests"], stats["objects"]) == ("1", "2")
+    assert main(["cache", "prune", "--max-age", "1d"]) == 0
+    assert main(["cache", "prune", "--max-size", "0"]) == 0
+    stats = _cache_stats(capsys)
+    assert (stats["manifests"], stats["objects"], stats["size"]) == ("0", "0", "0 B")
+
+
+def test_read_only_shared_cache(specs, tmp_path, monkeypatch):
+    import errno
+
+    shared = tmp_path / "shared"
+    monkeypatch.setenv("GHGEN_SHARED_CACHE", str(shared))
+    specs.write("a.py", _counting_spec("one"))
+    assert specs.run("--cache-directory", str(tmp_path / "local1")) == 0
+    for path in shared.rglob("*"):
+        path.chmod(0o555 if path.is_dir() else 0o444)
+
+    # as on a read-only mount, which also applies to root
+    def utime(path, *args, **kwargs):
+        raise OSError(errno.EROFS, "Read-only file system", str(path))
+
+    monkeypatch.setattr(os, "utime", utime)
+    try:
+        assert specs.run("--cache-directory", str(tmp_path / "local2")) == 0
+    finally:
+        for path in shared.rglob("*"):
+            path.chmod(0o755 if path.is_dir() else 0o644)
+    assert _runs(specs, "a.py") == 1
+
+
+def test_dependencies(specs, capsys):
+    specs.write_lib("helper.py", "import helper_dep\n")
+    specs.write_lib("helper_dep.py", "")
+    specs.write_lib("unrelated.py", "")
+    specs.write("a.py", "import helper\n" + _counting_spec("one"))
+    specs.write("b.py", "from unrelated import *\n" + _counting_spec("two"))
+    specs.write("c.py", _counting_spec("three"))
+    assert specs.run() == 0
+    specs.write_lib("helper_dep.py", "x = 1\n")
+    assert specs.run() == 0
+    assert [_runs(specs, f) for f in ("a.py", "b.py", "c.py")] == [2, 1, 1]
+    specs.write_lib("unrelated.py", "x = 1\n")
+    assert specs.run() == 0
+    assert [_runs(specs, f) for f in ("a.py", "b.py", "c.py")] == [2, 2, 1]
+    capsys.readouterr()
+    assert specs.run(command="deps") == 0
+    lib = specs.dir.parent / "lib"
+    assert capsys.readouterr().out.splitlines() == [
+        f"{specs.dir / 'a.py'}: {lib / 'helper.py'} {lib / 'helper_dep.py'}",
+        f"{specs.dir / 'b.py'}: {lib / 'unrelated.py'}",
+        f"{specs.dir / 'c.py'}:",
+    ]
+    # the command does not shadow the module tracking dependencies
+    from src import ghgen
+
+    assert inspect.ismodule(ghgen.deps)
+
+
+def test_imports_are_only_tracked_while_building(specs, monkeypatch):
+    import builtins
+
+    from src import ghgen
+
+    specs.write_lib("helper.py", "message = 'hello'\n")
+    specs.write(
+        "a.py",
+        _counting_spec("one").replace(
+            'run("echo one")', "import helper\n    run(helper.message)"
+        ),
+    )
+    imports = []
+
+    def render_workflow(*args):
+        imports.append(builtins.__import__)
+        return original(*args)
+
+    original = ghgen.render_workflow
+    monkeypatch.setattr(ghgen, "render_workflow", render_workflow)
+    assert specs.run() == 0
+    assert imports == [builtins.__import__]
+    # imports done by workflow functions are still tracked
+    assert "# depends on: ../lib/helper.py\n" in (specs.out / "one.yml").read_text()
+    specs.write_lib("helper.py", "message = 'bye'\n")
+    assert specs.run() == 0
+    assert _runs(specs, "a.py") == 2
+
+
+def test_fingerprint_check(specs, caplog):
+    specs.write_lib("helper.py", "")
+    specs.write("a.py", "import helper\n" + _counting_spec("one", "two"))
+    specs.write("b.py", _counting_spec("three"))
+    assert specs.run("--no-cache") == 0
+    assert "# depends on: ../lib/helper.py" in (specs.out / "one.yml").read_text()
+    assert specs.run("--no-cache", "--check") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (1, 1)
+    assert specs.run("--no-cache", "--check", "--strict") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 2)
+    specs.write_lib("helper.py", "x = 1\n")
+    assert specs.run("--no-cache", "--check") == 1
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (3, 2)
+
+
+def test_fingerprint_covers_ghgen_sources(specs, monkeypatch):
+    from src.ghgen import fingerprint
+
+    specs.write("a.py", _counting_spec("one"))
+    assert specs.run("--no-cache") == 0
+    # as after changing serializers or emitters
+    monkeypatch.setattr(fingerprint, "_sources_digest", lambda: "changed")
+    assert specs.run("--no-cache", "--check") == 1
+    assert _runs(specs, "a.py") == 2
+
+
+def test_reuse_does_not_start_workers(specs, monkeypatch):
+    import concurrent.futures
+
+    for i in range(4):
+        specs.write(f"s{i}.py", _counting_spec(f"w{i}"))
+    assert specs.run("--jobs", "4") == 0
+
+    def pool(*args, **kwargs):
+        assert False, "worker pool started"
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", pool)
+    # from the cache
+    assert specs.run("--jobs", "4") == 0
+    assert specs.run("--jobs", "4", "--check") == 0
+    # from fingerprints
+    assert specs.run("--jobs", "4", "--check", "--no-cache") == 0
+    assert specs.run("--jobs", "4", command="deps") == 0
+    # a single miss is processed in this process
+    specs.write("s0.py", _counting_spec("w0", "x"))
+    assert specs.run("--jobs", "4") == 0
+    assert [_runs(specs, f"s{i}.py") for i in range(4)] == [2, 1, 1, 1]
+
+
+def test_fingerprint_detects_output_changes(specs, caplog):
+    specs.write("a.py", _counting_spec("one", "two"))
+    assert specs.run("--no-cache") == 0
+    one = specs.out / "one.yml"
+    original = one.read_text()
+    one.write_text(original.replace("echo one", "echo uno"))
+    assert specs.run("--no-cache", "--check") == 1
+    one.write_text(original)
+    assert specs.run("--no-cache", "--check") == 0
+    (specs.out / "two.yml").unlink()
+    assert specs.run("--no-cache", "--check") == 1
+    assert _runs(specs, "a.py") == 3
+
+
+def test_outputs_are_read_as_utf8(specs):
+    # escaped, so that only outputs are not ASCII
+    specs.write(
+        "a.py", _workflow_spec("one").replace("echo one", "echo \\u00e9t\\u00e9")
+    )
+    assert specs.run() == 0
+    assert "echo été" in (specs.out / "one.yml").read_text(encoding="utf-8")
+    src = pathlib.Path(__file__).parents[1] / "src"
+    code = (
+        "import pathlib, sys, ghgen\n"
+        "assert ghgen.main(sys.argv[1:]) == 0\n"
+        "opts = ghgen.options(sys.argv[1:])\n"
+        "opts.cache_directory = None\n"
+        "f = pathlib.Path(sys.argv[-1], 'a.py')\n"
+        "assert ghgen._known_dependencies(f, opts) == set()\n"
+    )
+    # with an ASCII locale encoding
+    env = os.environ | {
+        "PYTHONPATH": str(src),
+        "LC_ALL": "C",
+        "PYTHONUTF8": "0",
+        "PYTHONCOERCECLOCALE": "0",
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", code, *specs.args("--check", "--no-cache", "-j", "1")],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr
+
+
+def test_regenerate_reloads_changed_modules(specs, caplog):
+    specs.write_lib("helper.py", "message = 'hello'\n")
+    specs.write("a.py", _counting_spec("one").replace('"echo one"', "helper.message"))
+    specs.write("a.py", "import helper\n" + (specs.dir / "a.py").read_text())
+    specs.write("b.py", _counting_spec("two"))
+    opts = options(specs.args("--no-cache"))
+    assert main(specs.args("--no-cache")) == 0
+    specs.write_lib("helper.py", "message = 'bye'\n")
+    assert _regenerate(opts, {specs.dir.parent / "lib" / "helper.py"}) == 0
+    assert "- run: bye" in (specs.out / "one.yml").read_text()
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 1)
+    assert _regenerate(opts, {specs.dir.parent / "lib" / "unrelated.py"}) is None
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 1)
+
+
+@pytest.mark.parametrize("reuse", [(), ("--check", "--no-cache")])
+def test_regenerate_after_reusing_outputs(specs, reuse):
+    from src.ghgen import deps
+
+    helper = specs.dir.parent / "lib" / "helper.py"
+    specs.write_lib("helper.py", "message = 'hello'\n")
+    specs.write("a.py", _counting_spec("one").replace('"echo one"', "helper.message"))
+    specs.write("a.py", "import helper\n" + (specs.dir / "a.py").read_text())
+    specs.write("b.py", _counting_spec("two"))
+    assert specs.run() == 0
+    # as in a new process, taking outputs from the cache or checking their fingerprints
+    deps.reset()
+    assert specs.run(*reuse) == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (1, 1)
+    specs.write_lib("helper.py", "message = 'bye'\n")
+    assert _regenerate(options(specs.args()), {helper}) == 0
+    assert "- run: bye" in (specs.out / "one.yml").read_text()
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 1)
+
+
+@pytest.mark.parametrize("watcher", [Inotify, Poller])
+def test_watcher(tmp_path, watcher, monkeypatch):
+    monkeypatch.setattr(Poller, "interval", 0.01)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.py").write_text("")
+    w = watcher([tmp_path])
+    try:
+        assert w.wait(0.05) == set()
+        (tmp_path / "a.py").write_text("x = 1")
+        (tmp_path / "sub" / "b.py").write_text("")
+        (tmp_path / "c.txt").write_text("")
+        assert w.wait(1) == {tmp_path / "a.py", tmp_path / "sub" / "b.py"}
+        (tmp_path / "a.py").unlink()
+        assert w.wait(1) == {tmp_path / "a.py"}
+    finally:
+        w.close()
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    path = tmp_path / "server.sock"
+    monkeypatch.setenv(client.socket_env_var, str(path))
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys; from src.ghgen import main; sys.exit(main(sys.argv[1:]))",
+            "serve",
+            "--socket",
+            str(path),
+        ],
+        cwd=pathlib.Path(__file__).parent.parent,
+    )
+    deadline = time.monotonic() + 10
+    while not path.exists():
+        assert server.poll() is None and time.monotonic() < deadline
+        time.sleep(0.01)
+    yield path
+    server.terminate()
+    server.wait()
+
+
+def test_server(specs, server, capsys):
+    specs.write_lib("helper.py", "message = 'hello'\n")
+    specs.write("a.py", "import helper\n" + _counting_spec("one"))
+    specs.write(
+        "a.py", (specs.dir / "a.py").read_text().replace('"echo one"', "helper.message")
+    )
+    assert client.main(specs.args()) == 0
+    assert client.main(specs.args("--check")) == 0
+    assert client.main(specs.args("--check", "--strict")) == 0
+    assert _runs(specs, "a.py") == 2
+    specs.write_lib("helper.py", "message = 'bye'\n")
+    assert client.main(specs.args()) == 0
+    assert "- run: bye" in (specs.out / "one.yml").read_text()
+    assert client.main(specs.args(command="deps")) == 0
+    assert client.main(["--no-such-option"]) == 2
+    out, err = capsys.readouterr()
+    assert out == f"{specs.dir / 'a.py'}: {specs.dir.parent / 'lib' / 'helper.py'}\n"
+    assert f"INFO     → {specs.out / 'one.yml'}\n" in err
+    assert f"INFO     ✅ {specs.out / 'one.yml'}\n" in err
+    assert "unrecognized arguments: --no-such-option" in err
+
+
+def test_client_without_server(specs, tmp_path, monkeypatch):
+    monkeypatch.setenv(client.socket_env_var, str(tmp_path / "no-server.sock"))
+    specs.write("a.py", _workflow_spec("one"))
+    assert client.main(specs.args()) == 0
+    assert (specs.out / "one.yml").exists()
+
+
+def test_watch_is_not_served(specs):
+    from src.ghgen import _serve_request, watch_workflows
+
+    # `ghgen.watch` is imported by this module, which must not shadow the command
+    assert options(specs.args(command="watch")).command is watch_workflows
+    assert _serve_request(specs.args(command="watch")) == 2
+
+
+def test_scan_source():
+    source = textwrap.dedent(
+        """
+        from ghgen.ctx import *
+        from ghgen.ctx import workflow as wf
+        import ghgen.ctx
+
+        @workflow
+        def one(): ...
+
+        @workflow(id="TWO")
+        def two(): ...
+
+        @ghgen.ctx.workflow()
+        def three(): ...
+
+        @wf(id=compute())
+        def four(): ...
+
+        def five(): ...
+
+        six = workflow(five)
+        seven = workflow(lambda: None, id="seven")
+
+        def helper():
+            return wf(five, id="eight")
+
+        @job
+        def not_a_workflow(): ...
+        """
+    )
+    assert scan_source(source) == [
+        Declaration("one", 7),
+        Declaration("TWO", 10),
+        Declaration("three", 13),
+        Declaration(None, 16),
+        Declaration("five", 20),
+        Declaration("seven", 21),
+        Declaration("eight", 24),
+    ]
+
+
+def test_scan_skips_files_without_workflows(specs, caplog):
+    specs.write("a.py", _counting_spec("one"))
+    specs.write(
+        "b.py", _counting_spec().replace("from ghgen", "import ghgen\nfrom ghgen")
+    )
+    specs.write(
+        "c.py", _counting_spec().replace("from ghgen.ctx import *", "import sys")
+    )
+    assert specs.run("--no-cache") == 0
+    assert _runs(specs, "a.py") == 1
+    assert not (specs.dir / "b.runs").exists()
+    assert not (specs.dir / "c.runs").exists()
+    assert specs.run("--no-cache", "--no-scan") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py"), _runs(specs, "c.py")) == (
+        2,
+        1,
+        1,
+    )
+
+
+def test_list(specs, capsys):
+    specs.write("a.py", _counting_spec("one", "two"))
+    specs.write("b.py", "raise Exception('should not run')\n" + _workflow_spec("three"))
+    specs.write("c.py", "x = 42\n")
+    assert specs.run(command="list") == 0
+    assert not (specs.dir / "a.runs").exists()
+    a, b = specs.dir / "a.py", specs.dir / "b.py"
+    assert capsys.readouterr().out.splitlines() == [
+        f"one {a}:8 {specs.out / 'one.yml'}",
+        f"two {a}:14 {specs.out / 'two.yml'}",
+        f"three {b}:6 {specs.out / 'three.yml'}",
+    ]
+
+
+def test_changed_since(specs, monkeypatch, caplog):
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    monkeypatch.chdir(specs.dir.parent)
+    specs.write_lib("helper.py", "")
+    specs.write("a.py", "import helper\n" + _counting_spec("one"))
+    specs.write("b.py", _counting_spec("two"))
+    assert specs.run("--no-cache") == 0
+    git("init", "-q", ".")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+    assert specs.run("--no-cache", "--changed-since", "HEAD", "--strict") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (1, 1)
+    specs.write_lib("helper.py", "x = 1\n")
+    assert specs.run("--no-cache", "--changed-since", "HEAD") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 1)
+    git("commit", "-q", "-a", "-m", "change helper")
+    (specs.out / "two.yml").write_text("# edited\n")
+    assert specs.run("--no-cache", "--changed-since", "HEAD", "--check") == 1
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py")) == (2, 2)
+    specs.write("c.py", _counting_spec("three"))
+    assert specs.run("--no-cache", "--changed-since", "HEAD") == 0
+    assert (_runs(specs, "a.py"), _runs(specs, "b.py"), _runs(specs, "c.py")) == (
+        2,
+        3,
+        1,
+    )
+
+
+def test_check_leaves_no_temporary_files(specs, caplog):
+    specs.write("a.py", _workflow_spec("one", "two"))
+    assert specs.run() == 0
+    (specs.out / "one.yml").write_text("something else\n")
+    (specs.out / "two.yml").unlink()
+    caplog.clear()
+    assert specs.run("--check", "--strict") == 1
+    assert sorted(p.name for p in specs.out.iterdir()) == ["one.yml"]
+    errors = [m for level, m in _messages(caplog) if level == logging.ERROR]
+    assert f"--- {specs.out / 'one.yml'}" in errors
+    assert f"+++ {specs.out / 'one.yml'} (generated)" in errors
+    assert "-something else" in errors
+    assert f"+++ {specs.out / 'two.yml'} (generated)" in errors
+
+
+def test_unchanged_outputs_are_not_touched(specs, caplog):
+    specs.write("a.py", _workflow_spec("one"))
+    specs.write("b.py", _workflow_spec("two"))
+    assert specs.run() == 0
+    one = specs.out / "one.yml"
+    os.utime(one, ns=(0, 0))
+    specs.write("b.py", _workflow_spec("two").replace("echo two", "echo deux"))
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    assert specs.run() == 0
+    assert one.stat().st_mtime_ns == 0
+    assert "echo deux" in (specs.out / "two.yml").read_text()
+    assert (logging.INFO, f"= {one}") in _messages(caplog)
+    assert (logging.INFO, f"→ {specs.out / 'two.yml'}") in _messages(caplog)
+
+
+def test_nothing_is_written_on_errors(specs, caplog):
+    specs.write("a.py", _workflow_spec("one"))
+    specs.write("b.py", _workflow_spec("two"))
+    assert specs.run() == 0
+    before = {p.name: p.read_text() for p in specs.out.iterdir()}
+    specs.write("a.py", _workflow_spec("one").replace("echo one", "echo uno"))
+    specs.write("b.py", _workflow_spec("two").replace('"echo', 'f"{matrix.x}'))
+    specs.write("c.py", _workflow_spec("three"))
+    assert specs.run() == 1
+    assert {p.name: p.read_text() for p in specs.out.iterdir()} == before
+    assert (
+        logging.ERROR,
+        "2 changed workflow(s) not written because of errors",
+    ) in _messages(caplog)
+
+
+def test_shards_partition_inputs(specs, tmp_path, caplog):
+    ids = [f"wf{i}" for i in range(10)]
+    for id in ids:
+        specs.write(f"{id}.py", _workflow_spec(id))
+    for i in range(1, 4):
+        assert (
+            specs.run("--shard", f"{i}/3", "--results", str(tmp_path / f"{i}.json"))
+            == 0
+        )
+    assert sorted(p.stem for p in specs.out.iterdir()) == ids
+    shards = [shard.Results.load(tmp_path / f"{i}.json") for i in range(1, 4)]
+    assert sorted(k for r in shards for k in r.inputs) == sorted(
+        str(specs.dir / f"{id}.py") for id in ids
+    )
+    # same partition on rerun
+    assert specs.run("--shard", "2/3", "--results", str(tmp_path / "again.json")) == 0
+    assert shard.Results.load(tmp_path / "again.json").inputs == shards[1].inputs
+    results = [str(tmp_path / f"{i}.json") for i in range(1, 4)]
+    timings = tmp_path / "timings.json"
+    assert main(["merge-results", "--timings", str(timings), *results]) == 0
+    assert sorted(shard.load_timings(timings)) == sorted(
+        shards[0].inputs + shards[1].inputs + shards[2].inputs
+    )
+
+
+def test_merge_results_reports_failures(specs, tmp_path, caplog):
+    specs.write("a.py", _workflow_spec("one"))
+    specs.write("b.py", _workflow_spec("two").replace('"echo', 'f"{matrix.x}'))
+    results = []
+    for i in range(1, 3):
+        results.append(str(tmp_path / f"{i}.json"))
+        specs.run("--shard", f"{i}/2", "--results", results[-1])
+    caplog.clear()
+    assert main(["merge-results", *results]) == 1
+    assert any(
+        "matrix" in m for level, m in _messages(caplog) if level == logging.ERROR
+    )
+    caplog.clear()
+    assert main(["merge-results", results[0]]) == 1
+    assert (logging.ERROR, "missing results for shard(s) [2] out of 2") in _messages(
+        caplog
+    )
+
+
+def test_shard_assignment():
+    keys = [f"f{i}.py" for i in range(20)]
+    plain = shard.assign(keys, 4)
+    assert set(plain.values()) <= {1, 2, 3, 4}
+    # hash-based assignment does not depend on other keys
+    assert shard.assign(keys[:5], 4) == {k: plain[k] for k in keys[:5]}
+    weights = {"f0.py": 10.0, "f1.py": 1.0, "f2.py": 1.0, "f3.py": 1.0}
+    weighted = shard.assign(keys[:4], 2, weights)
+    assert weighted["f0.py"] not in {weighted[k] for k in ("f1.py", "f2.py", "f3.py")}
+    with pytest.raises(argparse.ArgumentTypeError):
+        shard.parse("3/2")
+
+
+def _import_ghgen(*args: str) -> subprocess.CompletedProcess:
+    src = pathlib.Path(__file__).parents[1] / "src"
+    code = "import sys, ghgen; print(' '.join(sys.modules))"
+    return subprocess.run(
+        [sys.executable, *args, "-c", code],
+        env=os.environ | {"PYTHONPATH": str(src)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_import_is_light():
+    loaded = set(_import_ghgen().stdout.split())
+    for heavy in ("ruamel.yaml", "colorlog", "argparse", "difflib", "inflection"):
+        assert heavy not in loaded
+    # nor are YAML emitters, nor the modules specs need, which import the above
+    for heavy in ("_ruamel_yaml", "ghgen.ctx", "ghgen.workflow", "ghgen.element"):
+        assert heavy not in loaded
+
+
+# generous, as this is meant to catch heavy modules creeping back into `import ghgen` rather than
+# to benchmark it
+_import_time_budget_us = 150_000
+
+
+@pytest.mark.benchmark
+def test_import_time():
+    result = _import_ghgen("-X", "importtime")
+    (cumulative,) = (
+        int(line.split("|")[1])
+        for line in result.stderr.splitlines()
+        if line.split("|")[-1].strip() == "ghgen"
+    )
+    assert cumulative < _import_time_budget_us
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_timings(specs, capsys, jobs):
+    specs.write("a.py", _workflow_spec("one", "two"))
+    specs.write("b.py", _workflow_spec("three"))
+    # cached workflows are generated anew, so that they are timed as well
+    assert specs.run() == 0
+    assert specs.run("--jobs", jobs, "--timings", "2") == 0
+    report = capsys.readouterr().err
+    phases = report.split("\n\n")[0].splitlines()
+    assert phases[0].split() == ["phase", "wall", "ms", "cpu", "ms", "%", "calls"]
+    assert {l.split()[0] for l in phases[1:]} == {
+        "exec",
+        "build",
+        "validate",
+        "asdict",
+        "dump",
+        "diff",
+        "total",
+    }
+    walls = [float(l.split()[1]) for l in phases[1:-1]]
+    assert walls == sorted(walls, reverse=True)
+    slowest = report.split("\n\n")[1].splitlines()
+    assert slowest[0].startswith("slowest 2")
+    assert len(slowest) == 3
+
+
+def test_trace(specs, tmp_path):
+    specs.write(
+        "a.py",
+        """
+        from ghgen.ctx import *
+
+        @workflow
+        def one():
+            on.workflow_dispatch()
+
+            @job
+            def build():
+                run("make")
+        """,
+    )
+    specs.write("b.py", _workflow_spec("two"))
+    trace = tmp_path / "trace.json"
+    # like `--timings`, so that cached workflows are traced as well
+    assert options(specs.args("--trace", str(trace))).strict
+    assert specs.run("--no-cache", "--jobs", "2", "--trace", str(trace)) == 0
+    events = json.loads(trace.read_text())["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert {e["name"] for e in spans} >= {
+        "spec",
+        "exec",
+        "build",
+        "job",
+        "validate",
+        "asdict",
+        "dump",
+        "diff",
+        "write",
+    }
+    (job,) = (e for e in spans if e["name"] == "job")
+    assert job["args"] == {"job": "build", "workflow": "one"}
+    (build,) = (
+        e for e in spans if e["name"] == "build" and e["args"]["workflow"] == "one"
+    )
+    assert build["args"]["file"] == str(specs.dir / "a.py")
+    assert build["pid"] == job["pid"]
+    assert (
+        build["ts"] <= job["ts"] <= job["ts"] + job["dur"] <= build["ts"] + build["dur"]
+    )
+    names = {e["pid"]: e["args"]["name"] for e in events if e["ph"] == "M"}
+    assert set(names.values()) == {"gh-gen", "gh-gen worker"}
+    assert names[build["pid"]] == "gh-gen worker"
+
+
+def test_metrics(specs, tmp_path):
+    specs.write(
+        "a.py",
+        _workflow_spec("one")
+        + """
+@workflow
+def two():
+    on.workflow_dispatch()
+    run(f"echo {github.event.foo} {github.event.foo}")
+""",
+    )
+    specs.write("b.py", _workflow_spec("three"))
+    out = tmp_path / "metrics.json"
+    assert specs.run("--jobs", "2", "--metrics", str(out)) == 0
+    metrics = json.loads(out.read_text())
+    counters, histograms = metrics["counters"], metrics["histograms"]
+    assert counters["cache.misses"] == 2
+    assert "cache.hits" not in counters
+    assert counters["expr.nodes"]["RefExpr"] > 0
+    assert counters["refexpr.intern.hits"] > 0
+    assert counters["rules.validate"] > 0
+    assert counters["io.files_written"] == 3
+    assert counters["io.bytes_written"] == histograms["output.bytes"]["sum"] > 0
+    assert histograms["output.bytes"]["count"] == 3
+    assert histograms["spec.seconds"]["count"] == 2
+    assert specs.run("--jobs", "2", "--metrics", str(out)) == 0
+    counters = json.loads(out.read_text())["counters"]
+    assert counters["cache.hits"] == 2
+    assert "io.bytes_written" not in counters
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_nothing_is_recorded_by_default(specs, monkeypatch, jobs):
+    from src.ghgen import metrics, timings
+
+    def recording(*args, **kwargs):
+        assert False, "instrumentation enabled"
+
+    monkeypatch.setattr(timings, "recording", recording)
+    monkeypatch.setattr(metrics, "collecting", recording)
+    specs.write("a.py", _workflow_spec("one"))
+    specs.write("b.py", _workflow_spec("two"))
+    assert specs.run("--no-cache", "--jobs", jobs) == 0
+
+
+def test_profile(specs, tmp_path, capsys):
+    specs.write("a.py", _workflow_spec("one", "two"))
+    specs.write("b.py", _workflow_spec("three"))
+    profile = tmp_path / "profile"
+    assert specs.run("--jobs", "2", "--profile", str(profile)) == 0
+    assert sorted(p.name for p in profile.iterdir()) == [
+        "all.pstats",
+        "one.pstats",
+        "three.pstats",
+        "two.pstats",
+    ]
+    report = capsys.readouterr().err
+    groups = {t.splitlines()[0].split()[0]: t for t in report.split("\n\n")}
+    assert "render_workflow" in groups["ghgen"]
+    assert "(one)" in groups["spec"] and "(three)" in groups["spec"]
+    assert "ghgen" not in groups["spec"]
+
+
+def test_memory_report(specs, capsys):
+    specs.write(
+        "a.py",
+        """
+        from ghgen.ctx import *
+
+        @workflow
+        def one():
+            on.workflow_dispatch()
+            for i in range(50):
+                run(f"echo {i}")
+        """,
+    )
+    specs.write("b.py", _workflow_spec("two"))
+    assert specs.run("--jobs", "2", "--memory-report", "3") == 0
+    tables = [t.splitlines() for t in capsys.readouterr().err.split("\n\n")]
+    phases = {l.split()[0] for l in tables[0][1:]}
+    assert {"exec", "build", "asdict", "dump", "diff"} <= phases
+    assert tables[1][0].split()[:2] == ["largest", "3"]
+    largest = [l.split()[0] for l in tables[1][1:]]
+    assert "a.py::one" in largest
+    groups = {t[0].split()[0]: t[1:] for t in tables[2:]}
+    assert all("ghgen" in l for l in groups["ghgen"])
+    assert groups["spec"][0].startswith(f"{specs.dir / 'a.py'}:8 ")
+
+
+def test_memory_report_with_timings_and_trace(specs, tmp_path, capsys):
+    specs.write("a.py", _workflow_spec("one"))
+    trace = tmp_path / "trace.json"
+    args = ("--memory-report", "3", "--timings", "2", "--trace", str(trace))
+    assert specs.run("--jobs", "1", *args) == 0
+    lines = capsys.readouterr().err.splitlines()
+    total = next(l.split() for l in lines if l.startswith("total"))
+    assert float(total[1]) > 0
+    assert any(l.split() == ["phase", "max", "peak"] for l in lines)
+    events = json.loads(trace.read_text())["traceEvents"]
+    assert {"spec", "exec", "dump"} <= {e["name"] for e in events if e["ph"] == "X"}
+
+
+def _large_output_spec(id: str) -> str:
+    return f"""
+        from ghgen.ctx import *
+
+        @workflow
+        def {id}():
+            on.workflow_dispatch()
+            for i in range(10):
+                run("\\n".join(f"echo {id} {{i}} {{j}}" for j in range(200)))
+        """
+
+
+def _peak_rss(specs, *args: str) -> int:
+    src = pathlib.Path(__file__).parents[1] / "src"
+    # unlike `getrusage`, this is not inherited from the parent process across `exec`
+    code = (
+        "import re, sys, ghgen\n"
+        "assert ghgen.main(sys.argv[1:]) == 0\n"
+        "with open('/proc/self/status') as status:\n"
+        "    print(re.search(r'VmHWM:\\s*(\\d+) kB', status.read())[1])\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code, *specs.args(*args)],
+        env=os.environ | {"PYTHONPATH": str(src)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(result.stdout) * 1024
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/status"), reason="requires Linux procfs"
+)
+def test_stream_memory_is_bounded(specs):
+    peaks = {}
+    for count in (5, 60):
+        for i in range(count):
+            specs.write(f"s{i}.py", _large_output_spec(f"w{i}"))
+        peaks[count] = _peak_rss(specs, "--stream", "--no-cache", "--jobs", "1")
+    written = sum(o.stat().st_size for o in specs.out.glob("*.yml"))
+    assert len(list(specs.out.glob("*.yml"))) == 60
+    # outputs add up to a few MiB, none of which should be held onto
+    assert peaks[60] - peaks[5] < written / 4
+
+
+def _large_workflow():
+    from src.ghgen.workflow import Job, Step, Workflow
+
+    ret = Workflow(name="large")
+    for j in range(20):
+        steps = [
+            Step(
+                id=f"s{i}",
+                name=f"step {i}",
+                if_="always()" if i % 2 else None,
+                run=f"echo {i}\necho done",
+                env={"A": "x", "B": str(i)},
+                with_={"key": "value"},
+            )
+            for i in range(100)
+        ]
+        ret.jobs[f"j{j}"] = Job(
+            name=f"job {j}",
+            needs=[f"j{j - 1}"] if j else None,
+            runs_on="ubuntu-latest",
+            env={"X": "1"},
+            steps=steps,
+        )
+    return ret
+
+
+def _reflective_serialize(self):
+    # `Element.asdict` as it used to be, working everything out for each instance
+    return {
+        self._key(f.name): _reflective_asobj(v)
+        for f in dataclasses.fields(self)
+        if (v := getattr(self, f.name)) is not None
+    }
+
+
+def _reflective_asobj(o):
+    from src.ghgen.element import Element, Expr, instantiate
+
+    match o:
+        case Element() as e:
+            return e.asdict()
+        case Expr() | str():
+            return instantiate(o)
+        case dict() as d:
+            return {
+                instantiate(k): _reflective_asobj(v)
+                for k, v in d.items()
+                if v is not None
+            }
+        case list() as l:
+            return [_reflective_asobj(x) for x in l]
+        case _:
+            return o
+
+
+def _subclasses(cls: type) -> typing.Iterator[type]:
+    for sub in cls.__subclasses__():
+        yield sub
+        yield from _subclasses(sub)
+
+
+def _reflective(monkeypatch):
+    from src.ghgen import element
+
+    for cls in _subclasses(element.Element):
+        monkeypatch.setattr(cls, "_serialize", _reflective_serialize)
+    monkeypatch.setattr(element, "asobj", _reflective_asobj)
+
+
+def test_serializers_are_precompiled(monkeypatch):
+    from src.ghgen import element
+
+    # worked out once for each class, rather than on each call
+    for cls in _subclasses(element.Element):
+        assert "_fields" in vars(cls) and "_serialize" in vars(cls)
+    expected = _large_workflow().asdict()
+    _reflective(monkeypatch)
+    # a new workflow, as serializations are kept
+    assert _large_workflow().asdict() == expected
+
+
+@pytest.mark.benchmark
+def test_precompiled_serializers_are_faster(monkeypatch):
+    def serialize() -> float:
+        times = []
+        for _ in range(5):
+            # a new workflow each time, as serializations are kept
+            w = _large_workflow()
+            start = time.perf_counter()
+            w.asdict()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    precompiled = serialize()
+    _reflective(monkeypatch)
+    reflective = serialize()
+    assert precompiled * 1.5 < reflective
+
+
+def test_json_format(specs):
+    from ruamel.yaml import YAML
+
+    specs.write(
+        "a.py",
+        """
+        from ghgen.ctx import *
+
+        @workflow
+        def one():
+            on.workflow_dispatch()
+            strategy.matrix(os=["ubuntu-latest", "windows-latest"])
+            runs_on(matrix.os)
+            run("echo a\\necho b")
+        """,
+    )
+    assert specs.run("--no-cache") == 0
+    yaml = (specs.out / "one.yml").read_text()
+    assert specs.run("--no-cache", "--format", "json") == 0
+    text = (specs.out / "one.yml").read_text()
+    body = text.splitlines()[-1]
+    assert text.startswith("# generated from a.py::one\n# fingerprint: ")
+    assert json.loads(body) == YAML(typ="safe").load(yaml)
+    # the whole output is still valid YAML
+    assert YAML(typ="safe").load(text) == json.loads(body)
+    assert specs.run("--format", "json", "--check") == 0
+    assert specs.run("--check") == 1
+    assert specs.run("--format", "json", "--check", "--no-cache") == 0
+    assert specs.run("--check", "--no-cache") == 1
+
+
+@pytest.mark.benchmark
+def test_libyaml_is_faster(specs):
+    specs.write(
+        "a.py",
+        """
+        from ghgen.ctx import *
+
+        @workflow
+        def one():
+            on.workflow_dispatch()
+            for i in range(2000):
+                step(f"step {i}").run(f"echo {i}")
+        """,
+    )
+
+    def generate(emitter: str) -> float:
+        def run():
+            # through `main`, so that rendering runs with imports of specs being tracked
+            assert specs.run("--no-cache", "--strict", "--emitter", emitter) == 0
+
+        return min(timeit.repeat(run, number=1, repeat=3))
+
+    assert generate("libyaml") * 1.5 < generate("ruamel")
+
+
+def _large_matrix_workflow():
+    from src.ghgen.workflow import Job, Matrix, Step, Strategy, Workflow
+
+    ret = Workflow(name="large matrix")
+    for j in range(20):
+        matrix = Matrix(
+            values={"os": ["ubuntu-latest", "windows-latest"], "python": ["3.12"]},
+            include=[{"os": f"os-{i}", "python": f"3.{i}"} for i in range(200)],
+        )
+        ret.jobs[f"j{j}"] = Job(
+            runs_on="${{ matrix.os }}",
+            strategy=Strategy(matrix=matrix),
+            steps=[Step(run=f"echo {i}") for i in range(20)],
+        )
+    return ret
+
+
+def test_json_uses_the_c_encoder(monkeypatch):
+    import json.encoder
+
+    from src.ghgen import emit
+
+    if json.encoder.c_make_encoder is None:
+        pytest.skip("`json` C accelerator not available")
+    calls = []
+
+    def c_make_encoder(*args):
+        calls.append(args)
+        return original(*args)
+
+    original = json.encoder.c_make_encoder
+    monkeypatch.setattr(json.encoder, "c_make_encoder", c_make_encoder)
+    out = io.StringIO()
+    data = _large_matrix_workflow().asdict()
+    emit.dump_json(data, out)
+    assert len(calls) == 1
+    assert json.loads(out.getvalue()) == data
+
+
+@pytest.mark.benchmark
+def test_json_is_faster():
+    from ruamel.yaml import CommentedMap
+
+    from src.ghgen import emit
+
+    data = _large_matrix_workflow().asdict()
+    as_yaml = min(
+        timeit.repeat(
+            lambda: emit.dump(CommentedMap(data), io.StringIO()), number=1, repeat=3
+        )
+    )
+    as_json = min(
+        timeit.repeat(lambda: emit.dump_json(data, io.StringIO()), number=1, repeat=3)
+    )
+    # about 35 times faster than the `libyaml` backend, and 500 times than the `ruamel` one
+    assert as_json * 10 < as_yaml
+
+
+def test_serializations_are_kept():
+    from src.ghgen import emit, metrics
+    from src.ghgen.workflow import Step
+
+    shared = Step(run="make", env={"A": "a"})
+    w = _large_matrix_workflow()
+    for job in w.jobs.values():
+        job.steps = [*job.steps, shared]
+    first = w.asdict()
+    with metrics.collecting() as registry:
+        assert w.asdict() == first
+    # jobs and triggers are reused as a whole, without going into their steps
+    assert registry.counters["asdict.reused"] == 20 + 1
+
+    # shared serializations are still written in full
+    for backend in ("ruamel", "libyaml"):
+        out = io.StringIO()
+        emit.dump(w, out, backend)
+        assert "&id" not in out.getvalue()
+        assert out.getvalue().count("run: make\n") == 20
+
+    # reassigning a field invalidates the serializations including it, however deep
+    shared.run = "make all"
+    w.jobs["j3"].strategy.matrix.include = [{"os": "x"}]
+    with metrics.collecting() as registry:
+        second = w.asdict()
+    # other steps, the shared one after its first use, other strategies and triggers
+    assert registry.counters["asdict.reused"] == 20 * 20 + 19 + 19 + 1
+    assert all(j["steps"][-1]["run"] == "make all" for j in second["jobs"].values())
+    assert second["jobs"]["j3"]["strategy"]["matrix"]["include"] == [{"os": "x"}]
+    assert second["jobs"]["j2"]["strategy"] == first["jobs"]["j2"]["strategy"]
+
+
+def test_anchors(specs, caplog):
+    from ruamel.yaml import YAML
+
+    specs.write(
+        "a.py",
+        """
+        from ghgen.ctx import *
+
+        @workflow
+        def one():
+            on.workflow_dispatch()
+            for name in ("a", "b", "c"):
+                @job(id=name)
+                def _():
+                    env(FOO="foo", BAR="bar", BAZ="baz")
+                    run("make")
+                    run("make test")
+        """,
+    )
+    assert specs.run() == 0
+    plain = (specs.out / "one.yml").read_text()
+    caplog.set_level(logging.INFO)
+    assert specs.run("--anchors", "20") == 0
+    text = (specs.out / "one.yml").read_text()
+    assert "&id001" in text and "*id001" in text
+    assert YAML(typ="safe").load(text) == YAML(typ="safe").load(plain)
+    saved = len(plain.encode()) - len(text.encode())
+    assert saved > 0
+    assert (logging.INFO, f"anchors save {saved} bytes in one") in _messages(caplog)
+    assert specs.run("--anchors", "20", "--check") == 0
+    assert specs.run("--check") == 1
+    assert specs.run("--anchors", "20", "--check", "--no-cache") == 0
+    assert specs.run("--anchors", "10", "--check", "--no-cache") == 1
+    assert specs.run("--check", "--no-cache") == 1
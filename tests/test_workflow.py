@@ -63,6 +63,41 @@ def test_pull_request():
     run("")
 
 
+def test_plain_element():
+    import io
+
+    from src.ghgen import emit
+    from src.ghgen.element import Element, asobj
+    from src.ghgen.workflow import On
+
+    # `On.status` has no fields
+    assert asobj(On(status=Element())) == {"status": {}}
+    for backend in emit.backends:
+        out = io.StringIO()
+        emit.dump(On(status=Element()), out, backend)
+        assert out.getvalue() == "status: {}\n"
+
+
+def test_converted_types_are_not_kept():
+    import gc
+    import weakref
+
+    from src.ghgen.element import Element, asobj
+
+    # like types defined by spec files, which are dropped when reloading them
+    class Custom(Element):
+        value: str
+
+    class Name(str):
+        pass
+
+    assert asobj(Custom(value=Name("x"))) == {"value": "x"}
+    refs = [weakref.ref(Custom), weakref.ref(Name)]
+    del Custom, Name
+    gc.collect()
+    assert all(r() is None for r in refs)
+
+
 @expect(
     """
 # generated from test_workflow.py::test_merge